@@ -54,6 +54,8 @@ Description: Test pixel digis.
 #include "DQMServices/Core/interface/MonitorElement.h"
 #include "DQMServices/Core/interface/DQMStore.h"
 #include "TF1.h"
+#include "TFile.h"
+#include "TROOT.h"
 #include "TTree.h"
 
 // CLHEP 
@@ -110,6 +112,8 @@ Phase2TrackerBXHistogram::Phase2TrackerBXHistogram(const edm::ParameterSet& iCon
     theThresholdSmearing_Endcap_(config_.getParameter<double>("ThresholdSmearing_Endcap")),
     theThresholdSmearing_Barrel_(config_.getParameter<double>("ThresholdSmearing_Barrel")),
     tof_smearing_(config_.getParameter<double>("TOFSmearing")),
+    dumpHits_(config_.getParameter<bool>("DumpHits")),
+    dumpFileName_(config_.getParameter<std::string>("DumpFileName")),
     GeVperElectron(3.61E-09), // 1 electron(3.61eV, 1keV(277e, mod 9/06 d.k.
     verbosity_(config_.getParameter<int>("VerbosityLevel"))
 {
@@ -145,8 +149,11 @@ Phase2TrackerBXHistogram::Phase2TrackerBXHistogram(const edm::ParameterSet& iCon
         dimensions_ = dims_per_subdet[subdet_];
     }
 
-
- 
+    dumpFile_ = nullptr;
+    dumpTree_ = nullptr;
+    if (dumpHits_){
+        Phase2TrackerBXHistogram::bookHitDump();
+    }
 }
 
 //
@@ -161,6 +168,47 @@ Phase2TrackerBXHistogram::~Phase2TrackerBXHistogram() {
     edm::LogInfo("Phase2TrackerBXHistogram")<< ">>> Destroy Phase2TrackerBXHistogram ";
     if (verbosity_ > 0)
         std::cout << ">>> Destroy Phase2TrackerBXHistogram " << std::endl;
+    if (dumpFile_){
+        dumpFile_->cd();
+        dumpTree_->Write();
+        dumpFile_->Close();
+        delete dumpFile_;
+        if (verbosity_ > 0)
+            std::cout << "Hit dump saved in " << dumpFileName_ << std::endl;
+    }
+}
+
+//
+// -- Hit dump
+//
+void Phase2TrackerBXHistogram::bookHitDump() {
+    /*
+        Open the hit dump file and book the TTree branches
+            - One entry per selected hit, before the parameter dependent selections (pt, subdetector)
+    */
+    if (dumpFileName_.empty()){
+        throw std::invalid_argument("DumpFileName must be provided when DumpHits is enabled");
+    }
+    dumpFile_ = TFile::Open(dumpFileName_.c_str(),"RECREATE");
+    if (!dumpFile_ || dumpFile_->IsZombie()){
+        throw std::runtime_error("Could not open hit dump file "+dumpFileName_);
+    }
+    dumpTree_ = new TTree("hits","Selected SimHits");
+    dumpTree_->Branch("event",    &hitDump_.event,    "event/I");
+    dumpTree_->Branch("trackId",  &hitDump_.trackId,  "trackId/I");
+    dumpTree_->Branch("detId",    &hitDump_.detId,    "detId/i");
+    dumpTree_->Branch("subdetId", &hitDump_.subdetId, "subdetId/I");
+    dumpTree_->Branch("layer",    &hitDump_.layer,    "layer/I");
+    dumpTree_->Branch("charge",   &hitDump_.charge,   "charge/F");
+    dumpTree_->Branch("tof",      &hitDump_.tof,      "tof/F");
+    dumpTree_->Branch("toa",      &hitDump_.toa,      "toa/F");
+    dumpTree_->Branch("pt",       &hitDump_.pt,       "pt/F");
+    dumpTree_->Branch("x",        &hitDump_.x,        "x/F");
+    dumpTree_->Branch("y",        &hitDump_.y,        "y/F");
+    dumpTree_->Branch("z",        &hitDump_.z,        "z/F");
+    gROOT->cd(); // Do not attach other objects to the dump file
+    if (verbosity_ > 0)
+        std::cout << "Hit dump booked in " << dumpFileName_ << std::endl;
 }
 //
 // -- DQM Begin Run 
@@ -396,12 +444,6 @@ void Phase2TrackerBXHistogram::runSimHit(T isim,double offset, const TrackerTopo
         std::cout<<"\tNot a tracker hit -> discarded"<<std::endl;
         return;
     }
-    if (tkpt < pTCut_){
-        if (verbosity_>1){
-            std::cout <<"PT "<<tkpt<<" below cut at "<<pTCut_<<" -> dismissed"<<std::endl; 
-        }
-        return;
-    }
 
     // Check dZ //
     float dZ = (*isim).entryPoint().z() - (*isim).exitPoint().z();  
@@ -458,6 +500,31 @@ void Phase2TrackerBXHistogram::runSimHit(T isim,double offset, const TrackerTopo
     }
 
 
+    // Dump hit information (once per event, before the parameter dependent selections) //
+    if (dumpHits_ && offset == offset_scan_.front()){
+        hitDump_.event    = event;
+        hitDump_.trackId  = tkid;
+        hitDump_.detId    = rawid;
+        hitDump_.subdetId = detId.subdetId();
+        hitDump_.layer    = layer;
+        hitDump_.charge   = charge;
+        hitDump_.tof      = tof;
+        hitDump_.toa      = toa;
+        hitDump_.pt       = tkpt;
+        hitDump_.x        = pdPos.x();
+        hitDump_.y        = pdPos.y();
+        hitDump_.z        = pdPos.z();
+        dumpTree_->Fill();
+    }
+
+    // Check pt //
+    if (tkpt < pTCut_){
+        if (verbosity_>1){
+            std::cout <<"PT "<<tkpt<<" below cut at "<<pTCut_<<" -> dismissed"<<std::endl; 
+        }
+        return;
+    }
+
     // Check if dimensions are fulfilled //
     if (std::hypot(pdPos.x(),pdPos.y()) < dimensions_.first.first || std::hypot(pdPos.x(),pdPos.y()) > dimensions_.first.second){
         if (verbosity_>1){
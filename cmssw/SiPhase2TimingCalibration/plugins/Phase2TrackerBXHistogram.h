@@ -33,6 +33,7 @@ class PixelDigi;
 class Phase2TrackerDigi;
 class TrackerGeometry;
 class TF1;
+class TFile;
 class TTree;
 
 namespace CLHEP {
@@ -74,6 +75,21 @@ class Phase2TrackerBXHistogram : public DQMEDAnalyzer{
             MonitorElement* positions2D;
             MonitorElement* positions2DAbs;
         };
+
+        struct HitDump{  // Per-hit quantities for the columnar dump
+            int event;
+            int trackId;
+            unsigned int detId;
+            int subdetId;
+            int layer;
+            float charge;
+            float tof;
+            float toa;
+            float pt;
+            float x;
+            float y;
+            float z;
+        };
         // Histogram booking //
         void bookHistograms(DQMStore::IBooker & ibooker, edm::Run const &  iRun ,
                 edm::EventSetup const &  iSetup ) override;
@@ -130,6 +146,12 @@ class Phase2TrackerBXHistogram : public DQMEDAnalyzer{
     
         HitsPositions hits_positions_;
 
+        // Hit dump //
+        void bookHitDump();
+        TFile* dumpFile_;
+        TTree* dumpTree_;
+        HitDump hitDump_;
+
         // Signal shape //
         std::vector<double> pulseShapeVec_;
         double cbc3PulsePolarExpansion(double x) const;
@@ -169,6 +191,8 @@ class Phase2TrackerBXHistogram : public DQMEDAnalyzer{
         double theThresholdSmearing_Endcap_;
         double theThresholdSmearing_Barrel_;
         double tof_smearing_;
+        bool dumpHits_;
+        std::string dumpFileName_;
 
         const float GeVperElectron; // 3.7E-09 
         int verbosity_;
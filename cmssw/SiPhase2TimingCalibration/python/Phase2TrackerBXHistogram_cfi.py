@@ -50,6 +50,8 @@ timeCalib = DQMEDAnalyzer('Phase2TrackerBXHistogram',
     ThresholdSmearing_Barrel = cms.double(0.),
     ThresholdSmearing_Endcap = cms.double(0.),
     TOFSmearing = cms.double(0.),
+    DumpHits = cms.bool(False),
+    DumpFileName = cms.string(""),
 )
 
 from Configuration.ProcessModifiers.premix_stage2_cff import premix_stage2
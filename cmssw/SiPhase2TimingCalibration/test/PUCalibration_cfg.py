@@ -52,6 +52,56 @@ options.register('verbose',
                  VarParsing.multiplicity.singleton,
                  VarParsing.varType.int,
                  "Verbose level : 0 (nothing) | 1 (track info) | 2 (BX scan info) | 3 (Firing of the hit detect) | 4 (full detail on algo)")
+options.register('dump',
+                 0,
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.int,
+                 "Dump the per-hit quantities in a TTree for offline emulation : 0 (no) | 1 (yes)")
+options.register('dumpfile',
+                 '',
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.string,
+                 "Path of the hit dump file (if empty, will be produced in the current directory)")
+options.register('points',
+                 '',
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.string,
+                 "Path to json file containing a list of analyzer parameters (threshold, thresholdsmearing, tofsmearing, pt, subdet), one analyzer is run per entry in folder Ph2TkBXHist_<index>")
+options.register('lean',
+                 0,
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.int,
+                 "Save the DQM histograms directly at the end of the job, without the event content output (no harvesting needed) : 0 (no) | 1 (yes)")
+options.register('nshards',
+                 1,
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.int,
+                 "Number of shards the N events are split into (each shard is processed by a separate job)")
+options.register('shard',
+                 0,
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.int,
+                 "Index of the shard to process (from 0 to nshards-1)")
+options.register('premix',
+                 0,
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.int,
+                 "Only produce the premixed pileup library (mixed events, without analyzer) in premixfile : 0 (no) | 1 (yes)")
+options.register('premixfile',
+                 '',
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.string,
+                 "Path of the premixed pileup library (if premix=0 and not empty, the events are read from it and the mixing is not run)")
+options.register('seed',
+                 0,
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.int,
+                 "Seed from which all the random generators (and the emulated offset) are derived, 0 to draw a random one")
+options.register('replica',
+                 0,
+                 VarParsing.multiplicity.singleton,
+                 VarParsing.varType.int,
+                 "Index of the replica of identical requests, only used by BXRun to derive a distinct seed")
 options.register('HSfile',
                  '',
                  VarParsing.multiplicity.singleton,
@@ -66,11 +116,21 @@ options.register('PUfile',
 
 options.parseArguments()
 
+# Events read from an existing premixed library #
+use_premix = len(options.premixfile) > 0 and not options.premix
+
+if options.shard < 0 or options.shard >= options.nshards:
+    raise RuntimeError('Shard %d is not in [0,%d['%(options.shard,options.nshards))
+# Events of this shard, the N events are split as evenly as possible #
+shard_events = options.N // options.nshards + (1 if options.shard < options.N % options.nshards else 0)
+shard_skip = options.shard * (options.N // options.nshards) + min(options.shard,options.N % options.nshards)
+
 import FWCore.ParameterSet.Config as cms
 
 from Configuration.StandardSequences.Eras import eras
 #process = cms.Process('MIX',eras.Phase2)
-process = cms.Process('MIX',eras.Phase2C17I13M9)
+# Process name of the library must differ from the one of the jobs reading it #
+process = cms.Process('PREMIX' if options.premix else 'MIX',eras.Phase2C17I13M9)
 
 # import of standard configurations
 process.load('Configuration.StandardSequences.Services_cff')
@@ -94,7 +154,7 @@ from Configuration.AlCa.GlobalTag import GlobalTag
 process.GlobalTag = GlobalTag(process.GlobalTag, 'auto:phase2_realistic_T21','')
 
 process.maxEvents = cms.untracked.PSet(
-    input = cms.untracked.int32(options.N),
+    input = cms.untracked.int32(shard_events),
 )
 
 def get_files(path,label):
@@ -114,10 +174,20 @@ def get_files(path,label):
             filenames.append(line)
     return cms.untracked.vstring(*filenames)
 
+def shard_files(files):
+    # Distinct subset of the input files for each shard (if there are enough of them) #
+    if options.nshards > 1 and len(files) >= options.nshards:
+        return cms.untracked.vstring(*list(files)[options.shard::options.nshards])
+    return files
+
 # Input source
+if use_premix:
+    hs_files = cms.untracked.vstring('file:'+options.premixfile)
+else:
+    hs_files = get_files(options.HSfile,'hard scattering')
 process.source = cms.Source("PoolSource",
     dropDescendantsOfDroppedBranches = cms.untracked.bool(False),
-    fileNames = get_files(options.HSfile,'hard scattering'),
+    fileNames = shard_files(hs_files),
     inputCommands = cms.untracked.vstring(
         'keep *',
         'drop *_genParticles_*_*',
@@ -139,6 +209,9 @@ process.source = cms.Source("PoolSource",
     ),
     secondaryFileNames = cms.untracked.vstring()
 )
+if options.nshards > 1 and len(hs_files) < options.nshards:
+    # Not enough files to split them, each shard reads a distinct event range instead #
+    process.source.skipEvents = cms.untracked.uint32(shard_skip)
 
 
 process.options = cms.untracked.PSet(
@@ -162,7 +235,8 @@ process.mix.input.nbPileupEvents.averageNumber = cms.double(options.pileup)
 process.mix.bunchspace = cms.int32(25)
 process.mix.minBunch = cms.int32(0)
 process.mix.maxBunch = cms.int32(0)
-process.mix.input.fileNames = get_files(options.PUfile,'pileup')
+if not use_premix:
+    process.mix.input.fileNames = shard_files(get_files(options.PUfile,'pileup'))
 
 process.mix.mixObjects.mixSH.crossingFrames.extend([
         'TrackerHitsPixelBarrelHighTof',
@@ -183,9 +257,26 @@ process.mix.digitizers.mergedtruth.select.signalOnlyTP = cms.bool(False)
 process.dump = cms.EDAnalyzer("EventContentAnalyzer")
 
 
-# Output definition
+# Random generators, all derived from the seed so that a job can be reproduced
 import random
-if options.mode == 'scan':
+if options.seed <= 0:
+    options.seed = random.randrange(1,2**31)
+print ("Using seed %d"%options.seed)
+rng = random.Random(options.seed)
+
+# Output definition
+if len(options.points) > 0:
+    import json
+    with open(options.points,'r') as handle:
+        points = json.load(handle)
+else:
+    points = []
+if len(points) > 0 and options.mode == 'scan':
+    filename = 'BXHistGroup_N_{:d}_pileup_{:d}_points_{:d}_raw'.format(
+                    options.N,
+                    options.pileup,
+                    len(points))
+elif options.mode == 'scan':
     filename = 'BXHistScan_subdet_{:s}_N_{:d}_pileup_{:d}_pt_{:.01f}_threshold_{:d}_thresholdsmearing_{:0.1f}_tofsmearing_{:0.1f}_raw'.format(
                     options.subdet,
                     options.N,
@@ -196,7 +287,7 @@ if options.mode == 'scan':
                     options.tofsmearing)
 elif options.mode == 'emulate':
     if options.offset == -1.:
-        offset_emulate = round(random.random()*50,2)
+        offset_emulate = round(rng.random()*50,2)
     else:
         offset_emulate = round(options.offset,2)
     filename = 'BXHistEmulateDelay_{:0.2f}_subdet_{:s}_N_{:d}_pileup_{:d}_pt_{:.01f}_threshold{:d}_thresholdsmearing_{:0.1f}_tofsmearing_{:0.1f}_raw'.format(
@@ -241,16 +332,51 @@ process.timeCalib.Subdetector = cms.string(options.subdet)
 process.timeCalib.VerbosityLevel = cms.int32(options.verbose)
 if options.mode == 'emulate':
     process.timeCalib.OffsetEmulate = cms.double(offset_emulate)
+if options.dump:
+    if len(options.dumpfile) == 0:
+        dumpfile = 'HitDump_N_{:d}_pileup_{:d}'.format(options.N,options.pileup)+'.root'
+    else:
+        dumpfile = options.dumpfile
+    print ("Producing hit dump %s"%dumpfile)
+    process.timeCalib.DumpHits = cms.bool(True)
+    process.timeCalib.DumpFileName = cms.string(dumpfile)
 
 process.load('IOMC.RandomEngine.IOMC_cff')
-process.RandomNumberGeneratorService.generator.initialSeed  = random.randrange(1,10e07)
-process.RandomNumberGeneratorService.VtxSmeared.initialSeed = random.randrange(1,10e07)
-process.RandomNumberGeneratorService.g4SimHits.initialSeed  = random.randrange(1,10e07)
+process.RandomNumberGeneratorService.generator.initialSeed  = rng.randrange(1,100000000)
+process.RandomNumberGeneratorService.VtxSmeared.initialSeed = rng.randrange(1,100000000)
+process.RandomNumberGeneratorService.g4SimHits.initialSeed  = rng.randrange(1,100000000)
+# Pileup events picked by the mixing, otherwise identical for all jobs #
+process.RandomNumberGeneratorService.mix.initialSeed        = rng.randrange(1,100000000)
 setattr(process.RandomNumberGeneratorService,'timeCalib',cms.PSet(
-                    initialSeed = cms.untracked.uint32(random.randrange(1,10e07)),
+                    initialSeed = cms.untracked.uint32(rng.randrange(1,100000000)),
                     engineName  = cms.untracked.string('TRandom3'))
 )
 
+### One analyzer per point, sharing the same mixing
+if len(points) > 0:
+    process.digiana_seq = cms.Sequence()
+    for i,point in enumerate(points):
+        label = 'timeCalib%d'%i
+        analyzer = process.timeCalib.clone(
+            TopFolderName = cms.string('Ph2TkBXHist_%d'%i),
+            PTCut = cms.double(float(point['pt'])),
+            ThresholdInElectrons_Barrel = cms.double(float(point['threshold'])),
+            ThresholdInElectrons_Endcap = cms.double(float(point['threshold'])),
+            ThresholdSmearing_Barrel = cms.double(float(point['thresholdsmearing'])),
+            ThresholdSmearing_Endcap = cms.double(float(point['thresholdsmearing'])),
+            TOFSmearing = cms.double(float(point['tofsmearing'])),
+            Subdetector = cms.string(str(point['subdet'])),
+            DumpHits = cms.bool(bool(options.dump) and i == 0),
+        )
+        setattr(process,label,analyzer)
+        setattr(process.RandomNumberGeneratorService,label,cms.PSet(
+                            initialSeed = cms.untracked.uint32(rng.randrange(1,100000000)),
+                            engineName  = cms.untracked.string('TRandom3'))
+        )
+        process.digiana_seq += analyzer
+    delattr(process,'timeCalib')
+    print ("Running %d analyzers"%len(points))
+
 
 process.load('DQMServices.Components.DQMEventInfo_cfi')
 process.dqmEnv.subSystemFolder = cms.untracked.string('Ph2TkTB')
@@ -265,11 +391,48 @@ process.FEVTDEBUGoutput_step = cms.EndPath(process.FEVTDEBUGoutput)
 process.dqm_step =  cms.Path(process.digiana_seq * process.dqm_comm )
 
 process.mix_step = cms.Path(process.mix)
+# The mix products (crossing frames and tracking truth) are read from the library if used #
+mix_steps = [] if use_premix else [process.mix_step]
 # Schedule definition
-process.schedule = cms.Schedule(
-    process.mix_step,
-    process.dqm_step,
-    process.FEVTDEBUGoutput_step,
-    process.endjob_step
-)
+if options.premix:
+    # Mixed events only, the pileup is read from the library by the calibration jobs #
+    if len(options.premixfile) == 0:
+        premixfile = 'PremixLibrary_N_{:d}_pileup_{:d}'.format(options.N,options.pileup)+'.root'
+    else:
+        premixfile = options.premixfile
+    print ("Producing premixed library %s"%premixfile)
+    process.PREMIXoutput = cms.OutputModule("PoolOutputModule",
+        fileName = cms.untracked.string('file:'+premixfile),
+        outputCommands = cms.untracked.vstring(
+            'drop *',
+            'keep *_g4SimHits_*_*',
+            'keep *_mix_*_*',
+            'keep PileupSummaryInfos_*_*_*',
+        ),
+        splitLevel = cms.untracked.int32(0)
+    )
+    process.premix_step = cms.EndPath(process.PREMIXoutput)
+    process.schedule = cms.Schedule(
+        process.mix_step,
+        process.premix_step,
+        process.endjob_step
+    )
+elif options.lean:
+    # Histograms saved in the same file (and naming) as the harvester would produce #
+    process.load('DQMServices.Components.DQMFileSaver_cfi')
+    process.dqmSaver.workflow = '/Global/CMSSW_X_Y_Z/RECO'
+    process.dqmSaver.saveByRun = 1
+    process.dqmSaver.dirName = '.'
+    process.dqmsave_step = cms.EndPath(process.dqmSaver)
+    process.schedule = cms.Schedule(*(mix_steps + [
+        process.dqm_step,
+        process.endjob_step,
+        process.dqmsave_step
+    ]))
+else:
+    process.schedule = cms.Schedule(*(mix_steps + [
+        process.dqm_step,
+        process.FEVTDEBUGoutput_step,
+        process.endjob_step
+    ]))
 
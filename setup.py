@@ -6,6 +6,7 @@ if __name__ == '__main__':
             'console_scripts': [
             'BXRun=timeCal.utils.BXRun:main',
             'plotScan=timeCal.PlotScan.plotScan:main',
+            'BXEmulate=timeCal.Emulator.emulator:main',
             'runCalibration=timeCal.Calibration.runCalibration:main',
             ],
         },
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import json
+import argparse
+import numpy as np
+
+from ..utils.logger import Logger
+from ..utils.yamlLoader import parseYaml
+from ..utils.scan_utils import makeScan
+from ..utils.environment import getEnv
+from ..utils.result_store import ResultStore
+
+# Default values from Phase2TrackerBXHistogram_cfi.py #
+PULSE_SHAPE_PARAMETERS = [-3.0, 16.043703, 99.999857, 40.571650, 2.0, 1.2459094]
+BX_RANGE     = 5
+DEAD_TIME    = 2.7
+OFFSET_MIN   = 0.
+OFFSET_MAX   = 50.
+OFFSET_STEP  = 0.1
+
+# Constants of Phase2TrackerBXHistogram.h #
+BX_TIME             = 25.
+INTERPOLATION_STEP  = 10
+INTERPOLATION_POINTS = 1000
+TOB_SUBDET_ID       = 5
+
+# Separators for each set of modules (name : {r_min,r_max}, {z_min,z_max}) #
+SUBDET_DIMENSIONS = {
+    "ALL": ((0.,120.)   , (0.,280.)),
+    "BLL": ((20.,26.)   , (0.,6.5)),
+    "BLH": ((22.,30.)   , (116.,122.)),
+    "BHL": ((108.,114.) , (0.,20.)),
+    "BHH": ((108.,114.) , (80.,120.)),
+    "ELL": ((22.,28.)   , (128.,131.)),
+    "ELH": ((32.,50.5)  , (260.,270.)),
+    "EHL": ((93.,112.)  , (128.,131.)),
+    "EHH": ((92.,112.)  , (262.,268.)),
+}
+
+# Columns of the hit dump the emulator needs #
+HIT_COLUMNS = ['detId','subdetId','charge','toa','pt','x','y','z']
+HIT_TREE    = 'hits'
+
+DQM_DIR = 'DQMData/Run 1/Ph2TkBXHist/Run summary'
+MODES   = ['Sampled','Latched']
+
+# Defaults of the PUCalibration_cfg.py arguments that matter for the emulation #
+DEFAULT_POINT = {
+    'pt'                 : 2.,
+    'threshold'          : 5800,
+    'thresholdsmearing'  : 0.,
+    'tofsmearing'        : 0.,
+    'subdet'             : 'ALL',
+}
+
+
+def _nFactorial(n):
+    return math.gamma(n + 1)
+
+def _aScalingConstant(N,i):
+    return (-1)**i * _nFactorial(N) * _nFactorial(N + 2) / (_nFactorial(N - i) * _nFactorial(N + 2 - i) * _nFactorial(i))
+
+def cbc3PulsePolarExpansion(x,xOffset,parameters=PULSE_SHAPE_PARAMETERS):
+    """
+        Numpy port of Phase2TrackerBXHistogram::cbc3PulsePolarExpansion
+        Input  :
+            - x [np.ndarray] : times at which to evaluate the expansion
+            - xOffset [float|np.ndarray] : offset of the pulse (broadcastable with x)
+            - parameters [list] : pulse shape parameters (the first one is replaced by xOffset)
+        Return : np.ndarray of the expansion values
+    """
+    tau    = parameters[1]
+    r      = parameters[2]
+    theta  = parameters[3]
+    nTerms = int(parameters[4])
+
+    xx = np.asarray(x,dtype=np.float64) - xOffset
+    fN = np.zeros_like(xx)
+    for i in range(nTerms):
+        rTerm = r**i / (tau**(2.*i) * _nFactorial(i + 2))
+        angularTerm = sum(math.cos(theta)**(i - j) * math.sin(theta)**j for j in range(i+1))
+        temporalTerm = sum(_aScalingConstant(i,j) * xx**(i - j) * tau**j for j in range(i+1))
+        fN += rTerm * angularTerm * temporalTerm
+    return np.where(xx < 0, 0., fN)
+
+def signalShape(x,xOffset,parameters=PULSE_SHAPE_PARAMETERS):
+    """
+        Numpy port of Phase2TrackerBXHistogram::signalShape
+        Input  :
+            - x [np.ndarray] : times at which to evaluate the signal response
+            - xOffset [float|np.ndarray] : offset of the pulse (broadcastable with x)
+            - parameters [list] : pulse shape parameters (the first one is replaced by xOffset)
+        Return : np.ndarray of the signal response
+    """
+    tau       = parameters[1]
+    maxCharge = parameters[5]
+    xx = np.asarray(x,dtype=np.float64) - xOffset
+    return maxCharge * (np.exp(-xx / tau) * (xx / tau)**2 * cbc3PulsePolarExpansion(x,xOffset,parameters))
+
+def findBin(x,nbins,xmin,xmax):
+    """
+        Same logic as TAxis::FindBin for fixed bins, but 0-based
+        -> returns -1 for underflow and nbins for overflow
+    """
+    x = np.asarray(x,dtype=np.float64)
+    idx = np.floor(nbins * (x - xmin) / (xmax - xmin)).astype(np.int64)
+    idx = np.where(x < xmin, -1, idx)
+    idx = np.where(x >= xmax, nbins, idx)
+    return idx
+
+
+class HitEmulator:
+    """
+        Vectorized emulation of the hit detection of Phase2TrackerBXHistogram
+        All hits x offsets x relative BX x thresholds are evaluated as array operations
+    """
+    def __init__(self,pulseShapeParameters=PULSE_SHAPE_PARAMETERS,bxRange=BX_RANGE,deadTime=DEAD_TIME,
+                 offsetMin=OFFSET_MIN,offsetMax=OFFSET_MAX,offsetStep=OFFSET_STEP,
+                 memoryBudget=2**30,seed=None,logger=None):
+        self.pulseShapeParameters = list(pulseShapeParameters)
+        self.bxRange      = bxRange
+        self.deadTime     = deadTime
+        self.offsetMin    = offsetMin
+        self.offsetMax    = offsetMax
+        self.offsetStep   = offsetStep
+        self.memoryBudget = memoryBudget
+        self.rng          = np.random.default_rng(seed)
+        self.logger       = logger
+
+        self.offsets      = self.makeOffsets()
+        self.bxs          = np.arange(-self.bxRange,self.bxRange+1)
+        self.pulseShapes  = self.storeSignalShape()
+        self.latchedTimes = self.makeLatchedTimes()
+
+    def makeOffsets(self):
+        # Same accumulation as Phase2TrackerBXHistogram::dqmBeginRun #
+        offsets = [self.offsetMin]
+        offIt = self.offsetMin
+        while offIt <= self.offsetMax:
+            offIt += self.offsetStep
+            offsets.append(offIt)
+        return np.array(offsets)
+
+    def makeLatchedTimes(self):
+        # Float loop of select_hit_latchedMode #
+        times = []
+        i = np.float32(self.deadTime)
+        while i <= np.float32(BX_TIME):
+            times.append(i)
+            i = np.float32(i + np.float32(1.))
+        return np.array(times,dtype=np.float32)
+
+    def storeSignalShape(self):
+        # Integer division in storeSignalShape : value only changes every interpolation step #
+        x = (np.arange(INTERPOLATION_POINTS) // INTERPOLATION_STEP).astype(np.float64)
+        return signalShape(x[np.newaxis,:],self.offsets[:,np.newaxis],self.pulseShapeParameters)
+
+    @staticmethod
+    def _sampleTime(i):
+        # `float val = i * 0.1` #
+        return (i * 0.1).astype(np.float32).astype(np.float64)
+
+    def getSignalIndex(self,xval):
+        """
+            Index in the stored signal shape for each time value, reproducing getSignalScale
+            Return : (index [np.ndarray], valid [np.ndarray])
+        """
+        xval = np.asarray(xval,dtype=np.float64)
+        valid = (xval > 0.) & (xval * INTERPOLATION_STEP < self.pulseShapes.shape[1])
+        xs = np.where(valid,xval,1.)
+        idx = np.floor(xs * INTERPOLATION_STEP).astype(np.int64) + 1
+        # First i such that float(i*0.1) > xval, correcting for the float rounding #
+        idx = np.where(self._sampleTime(idx-1) > xs, idx-1, idx)
+        idx = np.where(self._sampleTime(idx) > xs, idx, idx+1)
+        idx = np.maximum(idx,np.floor(xs).astype(np.int64) * INTERPOLATION_STEP + 1)
+        idx = np.clip(idx-1,0,self.pulseShapes.shape[1]-1)
+        return idx,valid
+
+    def getSignalScale(self,xval):
+        """
+            Numpy port of getSignalScale, for all offsets at once
+            Input  :
+                - xval [np.ndarray] : times
+            Return : np.ndarray of shape (offsets,) + xval.shape
+        """
+        idx,valid = self.getSignalIndex(xval)
+        return self.pulseShapes[:,idx] * valid
+
+    def sampledValues(self,charge,toa):
+        """
+            Charge seen by the sampled mode (to be compared to the threshold)
+            Return : np.ndarray [offsets, hits, bx]
+        """
+        toa = toa[:,np.newaxis] - (self.bxs * np.float32(BX_TIME)).astype(np.float32)
+        sigScale = self.getSignalScale(BX_TIME - toa.astype(np.float64))
+        return sigScale * charge[np.newaxis,:,np.newaxis]
+
+    def latchedValues(self,charge,toa):
+        """
+            Charge seen by the latched mode at each sampling time (to be compared to the threshold)
+            Return : np.ndarray [offsets, hits, bx, samples]
+        """
+        toa = toa[:,np.newaxis] - (self.bxs * np.float32(BX_TIME)).astype(np.float32)
+        times = (np.float32(0.) - toa)[...,np.newaxis] + self.latchedTimes
+        sigScale = self.getSignalScale(times.astype(np.float64))
+        return sigScale * charge[np.newaxis,:,np.newaxis,np.newaxis]
+
+    @staticmethod
+    def select_hit_sampledMode(values,threshold):
+        """
+            Numpy port of select_hit_sampledMode
+            Input  :
+                - values [np.ndarray] : output of sampledValues [offsets, hits, bx]
+                - threshold [np.ndarray] : threshold per hit
+            Return : boolean np.ndarray [offsets, hits, bx]
+        """
+        return values > threshold[np.newaxis,:,np.newaxis]
+
+    @staticmethod
+    def select_hit_latchedMode(values,threshold):
+        """
+            Numpy port of select_hit_latchedMode
+            Input  :
+                - values [np.ndarray] : output of latchedValues [offsets, hits, bx, samples]
+                - threshold [np.ndarray] : threshold per hit
+            Return : boolean np.ndarray [offsets, hits, bx]
+        """
+        aboveThr = values > threshold[np.newaxis,:,np.newaxis,np.newaxis]
+        # Rising edge, the first sample cannot fire (lastPulse starts as true) #
+        return (~aboveThr[...,:-1] & aboveThr[...,1:]).any(axis=-1)
+
+    def selectHits(self,hits,pt,subdet):
+        """
+            Apply the selections of runSimHit that depend on the parameters
+            Input  :
+                - hits [dict(str:np.ndarray)] : hit columns
+                - pt [float] : pt cut
+                - subdet [str] : part of the OT to use
+            Return : dict(str:np.ndarray) of the selected hits
+        """
+        if subdet not in SUBDET_DIMENSIONS.keys():
+            raise ValueError(f'Subdetector {subdet} not understood')
+        (rmin,rmax),(zmin,zmax) = SUBDET_DIMENSIONS[subdet]
+        r = np.hypot(hits['x'],hits['y'])
+        z = np.abs(hits['z'])
+        mask = (hits['pt'] >= pt) & (r >= rmin) & (r <= rmax) & (z >= zmin) & (z <= zmax)
+        return {key:val[mask] for key,val in hits.items()}
+
+    def smearPerDetId(self,detIds,smearing):
+        # Same smearing value for all hits of a module (flat in [-smearing,smearing]) #
+        if smearing <= 0.:
+            return np.zeros(detIds.shape[0],dtype=np.float32)
+        uniqueIds,inverse = np.unique(detIds,return_inverse=True)
+        smears = self.rng.uniform(-smearing,smearing,uniqueIds.shape[0]).astype(np.float32)
+        return smears[inverse]
+
+    def emulate(self,hits,points):
+        """
+            Run the emulation for several parameter points
+            Points sharing pt, subdet and tofsmearing are evaluated in a single batch
+            Input  :
+                - hits [dict(str:np.ndarray)] : hit columns (see HIT_COLUMNS)
+                - points [list(dict)] : parameter points (see DEFAULT_POINT)
+            Return : list of histogram dicts (see makeHistograms), in the order of points
+        """
+        points = [{**DEFAULT_POINT,**point} for point in points]
+        groups = {}
+        for i,point in enumerate(points):
+            key = (float(point['pt']),str(point['subdet']),float(point['tofsmearing']))
+            groups.setdefault(key,[]).append(i)
+
+        results = [None] * len(points)
+        for (pt,subdet,tofsmearing),indices in groups.items():
+            if self.logger is not None:
+                self.logger.info(f'Emulating {len(indices)} points with pt = {pt}, subdet = {subdet}, tof smearing = {tofsmearing}')
+            selected = self.selectHits(hits,pt,subdet)
+            thresholds = [(float(points[i]['threshold']),float(points[i]['thresholdsmearing'])) for i in indices]
+            counts = self.emulateGroup(selected,thresholds,tofsmearing)
+            for j,i in enumerate(indices):
+                results[i] = self.makeHistograms({key:val[j] if key != 'hitsTrue' else val for key,val in counts.items()})
+        return results
+
+    def emulateGroup(self,hits,thresholds,tofsmearing):
+        """
+            Emulation of one group of thresholds on the same selected hits
+            Input  :
+                - hits [dict(str:np.ndarray)] : selected hit columns
+                - thresholds [list(tuple)] : (threshold,threshold smearing) values
+                - tofsmearing [float] : ToF smearing value
+            Return : dict of counts per threshold
+        """
+        nOff = self.offsets.shape[0]
+        nBX  = self.bxs.shape[0]
+        nThr = len(thresholds)
+        nHits = hits['charge'].shape[0]
+
+        charge   = hits['charge'].astype(np.float32)
+        toa      = (hits['toa'].astype(np.float32) + self.smearPerDetId(hits['detId'],tofsmearing)).astype(np.float32)
+        # Barrel and endcap are given the same threshold by the cfg #
+        thrs     = np.stack([(np.float32(thr) + self.smearPerDetId(hits['detId'],smear)).astype(np.float32) for thr,smear in thresholds]) \
+                    if nThr > 0 else np.zeros((0,nHits),dtype=np.float32)
+
+        counts = {
+            'bx'       : {mode:np.zeros((nThr,nOff,nBX),dtype=np.int64) for mode in MODES},
+            'att'      : {mode:np.zeros((nThr,nOff,nBX+1),dtype=np.int64) for mode in MODES},
+        }
+
+        # Chunk the hits to stay within the memory budget (latched values dominate) #
+        bytesPerHit = nOff * nBX * (self.latchedTimes.shape[0] * 9 + 9)
+        chunkSize = max(1,int(self.memoryBudget // bytesPerHit))
+        for start in range(0,nHits,chunkSize):
+            sl = slice(start,start+chunkSize)
+            sampled = self.sampledValues(charge[sl],toa[sl])
+            latched = self.latchedValues(charge[sl],toa[sl])
+            for t in range(nThr):
+                for mode,fired in zip(MODES,[self.select_hit_sampledMode(sampled,thrs[t,sl]),
+                                             self.select_hit_latchedMode(latched,thrs[t,sl])]):
+                    counts['bx'][mode][t] += fired.sum(axis=1)
+                    att = fired.sum(axis=2)
+                    counts['att'][mode][t] += np.stack([(att == k).sum(axis=1) for k in range(nBX+1)],axis=1)
+        counts['hitsTrue'] = nHits
+        return {
+            'bxSampled'  : counts['bx']['Sampled'],
+            'bxLatched'  : counts['bx']['Latched'],
+            'attSampled' : counts['att']['Sampled'],
+            'attLatched' : counts['att']['Latched'],
+            'hitsTrue'   : counts['hitsTrue'],
+        }
+
+    def makeHistograms(self,counts):
+        """
+            Fill the counts with the same binning as the DQM histograms of Phase2TrackerBXHistogram
+            Input  :
+                - counts [dict] : counts for a single threshold point
+            Return : dict(str:tuple) with path in the DQM directory as keys and (counts,edges...) as values
+        """
+        nOff = self.offsets.shape[0]
+        nx   = 2 * self.bxRange + 1
+        xmin,xmax = -self.bxRange-0.5, self.bxRange+0.5
+        ymin,ymax = self.offsetMin-self.offsetStep/2, self.offsetMax+self.offsetStep/2
+        xedges   = np.linspace(xmin,xmax,nx+1)
+        yedges   = np.linspace(ymin,ymax,nOff+1)
+        attEdges = np.linspace(-0.5,4.5,6)
+
+        # Fill(bx-0.5-1,offset) #
+        xbin = findBin(self.bxs-0.5-1,nx,xmin,xmax)
+        ybin = findBin(self.offsets,nOff,ymin,ymax)
+        xin  = (xbin >= 0) & (xbin < nx)
+        yin  = (ybin >= 0) & (ybin < nOff)
+        abin = findBin(np.arange(self.bxs.shape[0]+1),5,-0.5,4.5)
+        ain  = (abin >= 0) & (abin < 5)
+
+        def fill2D(values,xb,xmask,nbx):
+            h = np.zeros((nbx,nOff))
+            v = values[yin][:,xmask]
+            np.add.at(h,(xb[xmask][np.newaxis,:],ybin[yin][:,np.newaxis]),v)
+            return h
+
+        hists = {}
+        hitsTrue = np.full((nOff,nx),counts['hitsTrue'])
+        for mode in MODES:
+            bxCounts = counts[f'bx{mode}']
+            hists[f'Hist2D/OffsetScan{mode}']         = (fill2D(bxCounts,xbin,xin,nx),xedges,yedges)
+            hists[f'Hist2D/HitsTrueNumberScan{mode}'] = (fill2D(hitsTrue,xbin,xin,nx),xedges,yedges)
+            hists[f'Hist2D/AttributionScan{mode}']    = (fill2D(counts[f'att{mode}'],abin,ain,5),attEdges,yedges)
+            for i,offset in enumerate(self.offsets):
+                h = np.zeros(nx)
+                np.add.at(h,xbin[xin],bxCounts[i][xin])
+                hists[f'Hist1D/BXHistogram{mode}Offset{offset:f}'.replace('.','p')] = (h,xedges)
+        return hists
+
+
+def loadHits(paths,tree=HIT_TREE):
+    """
+        Load the hit dump(s) produced by Phase2TrackerBXHistogram
+        Input  :
+            - paths [str|list(str)] : path(s) to the ROOT files
+            - tree [str] : path of the TTree in the files
+        Return : dict(str:np.ndarray) of hit columns
+    """
+    import uproot
+    if isinstance(paths,str):
+        paths = [paths]
+    return uproot.concatenate([{path:tree} for path in paths],HIT_COLUMNS,library='np')
+
+def writeHistograms(path,hists):
+    """
+        Write the emulated histograms in the layout of the harvested DQM files
+        Input  :
+            - path [str] : output ROOT file path
+            - hists [dict] : output of HitEmulator.makeHistograms
+        Return : None
+    """
+    import uproot
+    with uproot.recreate(path) as F:
+        for name,hist in hists.items():
+            F[f'{DQM_DIR}/{name}'] = hist
+
+def makeFileName(point):
+    point = {**DEFAULT_POINT,**point}
+    filename = 'BXHistEmulatedScan_subdet_{:s}_pt_{:.01f}_threshold_{:d}_thresholdsmearing_{:0.1f}_tofsmearing_{:0.1f}_harvested'.format(
+                    str(point['subdet']),
+                    float(point['pt']),
+                    int(float(point['threshold'])),
+                    float(point['thresholdsmearing']),
+                    float(point['tofsmearing']))
+    return filename.replace('.','p')+'.root'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulation of the BX histograms from a hit dump')
+    parser.add_argument('--yaml',action='store',required=True,type=str,
+                        help='Config of the parameters to emulate (same format as BXRun)')
+    parser.add_argument('--hits',action='store',required=True,type=str,nargs='+',
+                        help='Path(s) to the hit dump ROOT file(s)')
+    parser.add_argument('--tree',action='store',required=False,type=str,default=HIT_TREE,
+                        help=f'Path of the hit TTree in the files [default = {HIT_TREE}]')
+    parser.add_argument('-o','--output',action='store',required=True,type=str,
+                        help='Name of subdir output directory (will be put in the `production` output directory)')
+    parser.add_argument('--seed',action='store',required=False,type=int,default=None,
+                        help='Seed of the smearing random generator')
+    parser.add_argument('-v','--verbose',action='store_true',default=False,
+                        help='Debug logger mode')
+    args = parser.parse_args()
+
+    logger = Logger('BXEmulate','debug' if args.verbose else 'info','console')
+
+    # Output directory #
+    if os.path.isabs(args.output):
+        outputDir = args.output
+    else:
+        outputDir = os.path.join(getEnv()['paths']['production'],args.output)
+    resultsDir = os.path.join(outputDir,'results')
+    if not os.path.exists(resultsDir):
+        os.makedirs(resultsDir)
+
+    # Parameters #
+    paramNames,paramValues = makeScan(parseYaml(args.yaml))
+    points = [{pN:pV for pN,pV in zip(paramNames,pVals)} for pVals in paramValues]
+    logger.info(f'Emulating {len(points)} points')
+
+    # Emulation #
+    hits = loadHits(args.hits,args.tree)
+    logger.info(f'Loaded {hits["charge"].shape[0]} hits from {len(args.hits)} file(s)')
+    emulator = HitEmulator(seed=args.seed,logger=logger)
+    results = emulator.emulate(hits,points)
+
+    # Save in the same layout as BXRun #
+    store = ResultStore(resultsDir,logger)
+    for point,hists in zip(points,results):
+        subdir = store.directory(point)
+        if not os.path.exists(subdir):
+            os.makedirs(subdir)
+        hist_file = os.path.join(subdir,makeFileName(point))
+        writeHistograms(hist_file,hists)
+        with open(os.path.join(subdir,'params.json'),'w') as handle:
+            json.dump(point,handle,indent=4)
+        store.mark(point,'done')
+        logger.debug(f'Saved {hist_file}')
+    store.save()
+    logger.info(f'Saved results in {resultsDir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+import threading
+import pandas as pd
+import pyarrow.parquet as pq
+
+MANIFEST_FILE = 'manifest.json'
+# Rows per row group of the scan table, rows are sorted by parameters so that the selections skip most groups #
+ROW_GROUP_SIZE = 50000
+# Number of saved files between two writes of the manifest, an interrupted run keeps the files saved before the last write #
+MANIFEST_FLUSH = 20
+
+def fileKey(path):
+    # Name of the cached content of an input file #
+    return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+
+def fileStat(path):
+    # Changes when the file or its parameters are rewritten #
+    stat = {}
+    for p in [path,os.path.join(os.path.dirname(path),'params.json')]:
+        st = os.stat(p)
+        stat[os.path.basename(p)] = [st.st_size,st.st_mtime_ns]
+    return stat
+
+
+class ContentCache:
+    """
+        Cache of the processed content of each input file, in <cache>/<output>/ (Parquet files)
+        -> each file is stored separately, with its size and modification time (and those of its params.json)
+        -> an entry is only valid for the same processor configuration
+        -> the table of the whole scan is kept next to it, and only rebuilt when a file changes
+        -> the table is sorted by parameters, so that loading can be restricted to some columns and parameter values
+        -> the manifest is written every MANIFEST_FLUSH saved files, files can be saved from several threads
+    """
+    def __init__(self,path,table,config,logger=None):
+        self.path = path
+        self.table = table
+        self.config = config
+        self.logger = logger
+        self.manifest_path = os.path.join(self.path,MANIFEST_FILE)
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path,'r') as handle:
+                self.manifest = json.load(handle)
+        else:
+            self.manifest = {'files':{},'table':None}
+
+    def partPath(self,f):
+        return os.path.join(self.path,f'{fileKey(f)}.parquet')
+
+    def isValid(self,f):
+        entry = self.manifest['files'].get(os.path.abspath(f))
+        if entry is None or entry['config'] != self.config:
+            return False
+        if not os.path.exists(self.partPath(f)):
+            return False
+        return entry['stat'] == fileStat(f)
+
+    def outdated(self,files):
+        # Files to (re)process #
+        return [f for f in files if not self.isValid(f)]
+
+    def save(self,f,content):
+        pd.DataFrame(content).to_parquet(self.partPath(f),index=False)
+        stat = fileStat(f)
+        with self.lock:
+            self.manifest['files'][os.path.abspath(f)] = {
+                'stat'   : stat,
+                'config' : self.config,
+            }
+            # The table of the scan needs to be rebuilt #
+            self.manifest['table'] = None
+            self.unsaved += 1
+            if self.unsaved >= MANIFEST_FLUSH:
+                self._writeManifest()
+
+    def saveManifest(self):
+        with self.lock:
+            self._writeManifest()
+
+    def _writeManifest(self):
+        # Written in a temporary file so that an interrupted write does not corrupt the manifest #
+        self.unsaved = 0
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path,'w') as handle:
+            json.dump(self.manifest,handle,indent=4)
+        os.replace(tmp_path,self.manifest_path)
+
+    def build(self,files,parameters):
+        # Concatenates the content of the files in the scan table #
+        df = pd.concat([pd.read_parquet(self.partPath(f)) for f in files],ignore_index=True)
+        df = df.sort_values([p for p in parameters if p in df.columns],ignore_index=True)
+        tmp_path = self.table + '.tmp'
+        df.to_parquet(tmp_path,index=False,row_group_size=ROW_GROUP_SIZE)
+        os.replace(tmp_path,self.table)
+        self.manifest['table'] = files
+        self.saveManifest()
+        if self.logger is not None:
+            self.logger.info(f'Saved cache in {self.table}')
+
+    def load(self,files,parameters,columns=None,selection=None):
+        """
+            Returns the content of the scan
+            Input :
+                - files [list] : input files, all valid in the cache
+                - parameters [list] : parameter columns, the table is sorted by them
+                - columns [list] : columns to read (None for all)
+                - selection [dict] : column -> list of values to keep (None for all)
+            Return :
+                - [pd.DataFrame] : content of the files
+        """
+        files = [os.path.abspath(f) for f in files]
+        if len(files) == 0:
+            return pd.DataFrame()
+        if self.manifest['table'] != files or not os.path.exists(self.table):
+            self.build(files,parameters)
+        # Only the columns present in the table can be selected (eg parameters missing from the params.json) #
+        names = pq.read_schema(self.table).names
+        if columns is not None:
+            columns = [column for column in columns if column in names]
+        filters = None
+        if selection is not None:
+            filters = [(column,'in',values) for column,values in selection.items() if column in names]
+            if len(filters) == 0:
+                filters = None
+        df = pd.read_parquet(self.table,columns=columns,filters=filters)
+        if self.logger is not None:
+            self.logger.info(f'Loaded {len(df)} rows and {len(df.columns)} columns from {self.table}')
+        return df
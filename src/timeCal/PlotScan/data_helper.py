@@ -1,5 +1,7 @@
 import os
 import sys
+import json
+import hashlib
 import numpy as np
 import pandas as pd
 from array import array
@@ -18,17 +20,23 @@ class Observable:
         Class helper to handle the obervable array values
         Transforms the pandas DataFrame into a multi-dim numpy array with labels tracking
     """
-    def __init__(self,array,labels,name=''):
+    def __init__(self,array,labels,name='',errors=None,index=None):
         """
             Initialize
             Input  :
                 - array [np.ndarray] : array of values
                 - labels [dict(str:np.ndarray)] : dict of labels of the values array with names and axes values
                 - name [str] (default = '') : name of the observable
+                - errors [np.ndarray] (default = None) : array of errors, same shape as the values
+                - index [dict(str:dict)] (default = None) : label value to index, for each label (built if not provided)
         """
         self.array  = array
         self.labels = labels
         self.name   = name
+        self.errors = errors
+        if index is None:
+            index = {key:{value:i for i,value in enumerate(values)} for key,values in labels.items()}
+        self.index  = index
 
     def PrintLabels(self):
         """
@@ -46,24 +54,27 @@ class Observable:
             Selects a subset of parameters
             Input  :
                 - **kwargs : either parameter values by name or dictionnary
-            Return : Observable instance with reduced array
+            Return : Observable instance with reduced array (view of the values, not a copy)
         """
         for key in kwargs.keys():
             if key not in self.labels.keys():
                 raise ValueError('Could not find label "{}" in data labels : ['.format(key)+','.join(self.labels.keys())+']')
-        arr_select = self.array
+        selection = []
         labels_select = {}
-        for idx,key in reversed(list(enumerate(self.labels.keys()))):
+        index_select = {}
+        for key in self.labels.keys():
             if key in kwargs.keys():
                 try:
-                    element = np.where(self.labels[key]==kwargs[key])[0][0]
-                except IndexError:
+                    selection.append(self.index[key][kwargs[key]])
+                except KeyError:
                     raise IndexError('Cannot find element with value {} of label "{}"'.format(kwargs[key],key))
-                arr_select = arr_select.take(element,idx)
             else:
+                selection.append(slice(None))
                 labels_select[key] = self.labels[key]
-        labels_select = {key:labels_select[key] for key in reversed(list(labels_select.keys()))}
-        return Observable(arr_select,labels_select)
+                index_select[key] = self.index[key]
+        selection = tuple(selection)
+        errors_select = None if self.errors is None else self.errors[selection]
+        return Observable(self.array[selection],labels_select,self.name,errors_select,index_select)
 
     def GetArray(self):
         """
@@ -73,6 +84,14 @@ class Observable:
         """
         return self.array
 
+    def GetErrors(self):
+        """
+            Returns the array of errors of the instance
+            Input  : None
+            Return : np.ndarray of the data errors (None if the observable has no error column)
+        """
+        return self.errors
+
     def GetLabels(self):
         """
             Returns the labels of the instance
@@ -95,6 +114,37 @@ class Observable:
         return np.r_[x[0]-d[0],x[0]+d[0],x[1:-1]+d[1:],x[-1]+d[-1]]
         #return np.concatenate(((x[:-1] - np.diff(x)/2)[:2],x[1:] + np.diff(x)/2))
 
+    def _getErrorsScan(self,*axes):
+        """
+            Get the errors in the same axes order as the scan values
+            Input  :
+                - *axes [str] : labels in the order of the scan axes
+            Return : np.ndarray of errors (None if the observable has no errors)
+        """
+        if self.errors is None:
+            return None
+        return self.errors.transpose(*[list(self.labels).index(axis) for axis in axes])
+
+    @staticmethod
+    def _fillRootHist(h,values,errors=None):
+        """
+            Fills a ROOT histogram from numpy arrays in a single call
+            Note : ROOT stores the bins (including under/overflow) with the global bin x + (nx+2)*(y + (ny+2)*z)
+                -> the values (indexed [x,y,z]) are written reversed in a zero-padded buffer
+            Input  :
+                - h [ROOT.TH1] : histogram with the same number of bins as the values (on each axis)
+                - values [np.ndarray] : bin contents
+                - errors [np.ndarray] (default = None) : bin errors, not set if None
+            Return : None
+        """
+        inner = tuple(slice(1,-1) for _ in range(values.ndim))
+        for arr,setter in ((values,h.SetContent),(errors,h.SetError)):
+            if arr is None:
+                continue
+            buf = np.zeros(tuple(n+2 for n in arr.shape[::-1]),dtype=np.float64)
+            buf[inner] = arr.transpose()
+            setter(buf.ravel())
+
 
     #######################################
     #              1D Plots               #
@@ -108,7 +158,7 @@ class Observable:
         if len(self.array.shape) != 1:
             raise RuntimeError('Current array is dimention {}, to build a TGraph scan you need to have a dimension 1 array, maybe you need to slice the obervable array'.format(len(self.array.shape)))
         xvalues = list(self.labels.values())[0]
-        yvalues = self.array
+        yvalues = np.ascontiguousarray(self.array) # Slices are views of the cube, ROOT needs contiguous buffers
         return xvalues,yvalues
 
     def GetRootTH1(self,name=''):
@@ -123,8 +173,7 @@ class Observable:
         xlabel = list(self.labels.keys())[0]
         h = ROOT.TH1F(name,name,
                       xedges.shape[0]-1, array('d',xedges))
-        for ix in range(xedges.shape[0]-1):
-            h.SetBinContent(ix+1,yval[ix])
+        self._fillRootHist(h,yval,self.errors)
         h.GetXaxis().SetTitle(xlabel)
         h.GetYaxis().SetTitle(self.name)
         return h
@@ -137,7 +186,7 @@ class Observable:
             Return : ROOT.TGraph of the scan
         """
         xval,yval = self._get1DScan()
-        g = ROOT.TGraph(xval.shape[0],xval,yval)
+        g = ROOT.TGraph(xval.shape[0],np.ascontiguousarray(xval,dtype=np.float64),np.ascontiguousarray(yval,dtype=np.float64))
         xlabel = list(self.labels.keys())[0]
         g.GetXaxis().SetTitle(xlabel)
         g.GetYaxis().SetTitle(self.name)
@@ -197,10 +246,7 @@ class Observable:
         h = ROOT.TH2F(name,name,
                       xedges.shape[0]-1, array('d',xedges),
                       yedges.shape[0]-1, array('d',yedges))
-
-        for ix in range(xedges.shape[0]-1):
-            for iy in range(yedges.shape[0]-1):
-                h.SetBinContent(ix+1,iy+1,values[ix,iy])
+        self._fillRootHist(h,values,self._getErrorsScan(x,y))
         h.GetXaxis().SetTitle(x)
         h.GetYaxis().SetTitle(y)
         h.GetZaxis().SetTitle(self.name)
@@ -218,15 +264,39 @@ class Observable:
         """
         xval,yval,values = self._get2DScan(x,y)
         X,Y = np.meshgrid(xval,yval,indexing='ij')
-        X = X.ravel().astype(np.float32)
-        Y = Y.ravel().astype(np.float32)
-        Z = values.ravel().astype(np.float32)
-        print (X.dtype,Y.dtype,Z.dtype)
+        # Missing points (NaN) are left out of the graph #
+        mask = np.isfinite(values).ravel()
+        X = np.ascontiguousarray(X.ravel()[mask],dtype=np.float64)
+        Y = np.ascontiguousarray(Y.ravel()[mask],dtype=np.float64)
+        Z = np.ascontiguousarray(values.ravel()[mask],dtype=np.float64)
         g = ROOT.TGraph2D(Z.shape[0],X,Y,Z)
+        g.SetName(name)
         g.GetXaxis().SetTitle(x)
         g.GetYaxis().SetTitle(y)
-        g.SetName(name)
-        return ROOT.TGraph2D(self.GetRootTH2(x,y,name))
+        g.GetZaxis().SetTitle(self.name)
+        return g
+
+    def GetRootTGraphs(self,x,y,name=''):
+        """
+            Return the TGraph scans along x, for each value of y, of a two parameters observable
+            Input  :
+                - x [str] : label in the x axis of the graphs
+                - y [str] : label of the graphs
+                - name [str] (default = '') : prefix of the names of the TGraphs (followed by "_<y>_<value>")
+            Return : dict(value:ROOT.TGraph) for each value of y
+        """
+        xval,yval,values = self._get2DScan(x,y)
+        # Single copy of all the curves, each graph reads one row #
+        X = np.ascontiguousarray(xval,dtype=np.float64)
+        Y = np.ascontiguousarray(values.transpose(),dtype=np.float64)
+        graphs = {}
+        for i,val in enumerate(yval):
+            g = ROOT.TGraph(X.shape[0],X,Y[i])
+            g.GetXaxis().SetTitle(x)
+            g.GetYaxis().SetTitle(self.name)
+            g.SetName('{}_{}_{}'.format(name,y,val) if len(name) > 0 else '{}_{}'.format(y,val))
+            graphs[val] = g
+        return graphs
 
     def Pyplot2D(self,x,y,ax,**kwargs):
         """
@@ -293,10 +363,7 @@ class Observable:
                       yedges.shape[0]-1, array('d',yedges),
                       zedges.shape[0]-1, array('d',zedges))
 
-        for ix in range(xedges.shape[0]-1):
-            for iy in range(yedges.shape[0]-1):
-                for iz in range(zedges.shape[0]-1):
-                    h.SetBinContent(ix+1,iy+1,iz+1,values[ix,iy,iz])
+        self._fillRootHist(h,values,self._getErrorsScan(x,y,z))
         h.GetXaxis().SetTitle(x)
         h.GetYaxis().SetTitle(y)
         h.GetZaxis().SetTitle(z)
@@ -311,15 +378,18 @@ class Data:
     """
         Class helper to extract information from the pandas DataFrame
     """
-    def __init__(self,df):
+    def __init__(self,df,cube_path=None):
         """
             Initialize with a pandas DataFrame
             Input  :
                 - df [pd.DataFrame] : dataframe of data values
+                - cube_path [str] (default = None) : path (without extension) where the cube of observables is memory-mapped, in memory if None
             Return : None
         """
         self.df = df
         self.parameters = self.df.columns
+        self.cube_path = cube_path
+        self.cube = None
 
     def SetParameters(self,parameters):
         """
@@ -333,6 +403,101 @@ class Data:
             if param not in self.df.columns:
                 raise RuntimeError('Parameter "{}" not found in the dataframe'.format(param))
         self.parameters = parameters
+        self.cube = None
+
+    def _buildCube(self):
+        """
+            Builds the cube of all the observables in a single groupby
+            Inputs : None
+            Return : None
+            -> self.cube [np.ndarray] : values with shape (observables, parameters...), NaN for missing points
+            -> self.cubeObservables [dict(str:int)] : observable name to index in the first axis
+            -> self.cubeLabels [dict(str:np.ndarray)] : values of each parameter
+            -> self.cubeIndex [dict(str:dict)] : parameter value to index, for each parameter
+            If cube_path is set, the cube is written in <cube_path>.npy and memory-mapped (read-only) :
+            -> each observable is contiguous on disk, the slices are only read when used
+            -> the file is reused as long as the parameters and the dataframe content are the same
+        """
+        axNames = list(self.parameters)
+        observables = [col for col in self.df.select_dtypes(include='number').columns if col not in axNames]
+        if self.cube_path is not None:
+            key = self._cubeKey(axNames,observables)
+            if self._loadCube(key):
+                return
+        grouped = self.df[axNames+observables].groupby(axNames)[observables].mean()
+        if len(axNames) == 1:
+            levels = [grouped.index]
+            codes = [grouped.index.get_indexer(grouped.index)]
+        else:
+            levels = list(grouped.index.levels)
+            codes = list(grouped.index.codes)
+        shape = (len(observables),) + tuple(len(level) for level in levels)
+        if self.cube_path is None:
+            cube = np.full(shape, np.nan)
+        else:
+            tmp_path = self.cube_path + '.tmp.npy'
+            cube = np.lib.format.open_memmap(tmp_path,mode='w+',dtype=np.float64,shape=shape)
+        # Filled one observable at a time, so that a memory-mapped cube is written without a full copy in memory #
+        for i,obs in enumerate(observables):
+            cube[i] = np.nan
+            cube[i][tuple(codes)] = grouped[obs].values
+        self.cubeObservables = {obs:i for i,obs in enumerate(observables)}
+        self.cubeLabels = {name:level.values for name,level in zip(axNames,levels)}
+        self.cubeIndex = {name:{value:i for i,value in enumerate(values)} for name,values in self.cubeLabels.items()}
+        if self.cube_path is None:
+            self.cube = cube
+        else:
+            cube.flush()
+            del cube
+            self._saveCube(tmp_path,key)
+
+    def _cubeKey(self,axNames,observables):
+        """
+            Hash of the cube content
+            Inputs :
+                - axNames [list(str)] : parameters
+                - observables [list(str)] : observables
+            Return : str
+        """
+        content = pd.util.hash_pandas_object(self.df[axNames+observables],index=False).values
+        return hashlib.sha1(json.dumps([axNames,observables]).encode()+content.tobytes()).hexdigest()[:16]
+
+    def _saveCube(self,tmp_path,key):
+        """
+            Moves the written cube to <cube_path>.npy, saves its labels in <cube_path>.json and maps it
+            Inputs :
+                - tmp_path [str] : path of the written cube
+                - key [str] : hash of the cube content
+            Return : None
+        """
+        os.replace(tmp_path,self.cube_path+'.npy')
+        meta = {
+            'key'         : key,
+            'observables' : list(self.cubeObservables.keys()),
+            'labels'      : {name:values.tolist() for name,values in self.cubeLabels.items()},
+        }
+        with open(self.cube_path+'.json','w') as handle:
+            json.dump(meta,handle)
+        self.cube = np.load(self.cube_path+'.npy',mmap_mode='r')
+
+    def _loadCube(self,key):
+        """
+            Maps the cube saved in <cube_path>.npy if it has the same content
+            Inputs :
+                - key [str] : hash of the cube content
+            Return : bool, True if the cube was loaded
+        """
+        if not os.path.exists(self.cube_path+'.npy') or not os.path.exists(self.cube_path+'.json'):
+            return False
+        with open(self.cube_path+'.json','r') as handle:
+            meta = json.load(handle)
+        if meta['key'] != key:
+            return False
+        self.cube = np.load(self.cube_path+'.npy',mmap_mode='r')
+        self.cubeObservables = {obs:i for i,obs in enumerate(meta['observables'])}
+        self.cubeLabels = {name:np.asarray(values) for name,values in meta['labels'].items()}
+        self.cubeIndex = {name:{value:i for i,value in enumerate(values)} for name,values in self.cubeLabels.items()}
+        return True
 
     def ListNames(self):
         """
@@ -353,15 +518,16 @@ class Data:
         """
         if observable not in self.df.columns:
             raise RuntimeError('Observable "{}" not found in the dataframe'.format(observable))
+        if self.cube is None:
+            self._buildCube()
+        if observable not in self.cubeObservables.keys():
+            raise RuntimeError('Observable "{}" is not numerical'.format(observable))
 
-        axNames = self.parameters
-        df = self.df[axNames+[observable]]
-        grouped = df.groupby(axNames)[observable].mean()
-        shape = tuple(map(len, grouped.index.levels))
-        arr = np.full(shape, np.nan)
-        arr[tuple(grouped.index.codes)] = grouped.values.flat
-        labels = {level.name:level.values for level in grouped.index.levels}
-        return Observable(arr,labels,observable)
+        # Views of the cube, the error is taken from the "<observable> error" column if present #
+        arr = self.cube[self.cubeObservables[observable]]
+        error = '{} error'.format(observable)
+        errors = self.cube[self.cubeObservables[error]] if error in self.cubeObservables.keys() else None
+        return Observable(arr,dict(self.cubeLabels),observable,errors,dict(self.cubeIndex))
 
     @classmethod
     def load_pickle(cls,path):
@@ -376,3 +542,18 @@ class Data:
         df = pd.read_pickle(path)
         return cls(df)
 
+    @classmethod
+    def load_parquet(cls,path,columns=None,filters=None):
+        """
+            Instantiate the Data class from a parquet file (eg plotScan cache)
+            Input  :
+                - path [str] : string of the path to the parquet file
+                - columns [list(str)] : columns to read [default = all]
+                - filters [list(tuple)] : row selection, eg [("Threshold","in",[5000.,6000.])] [default = all rows]
+            Return : Data instance
+        """
+        if not os.path.exists(path):
+            raise RuntimeError('File {} does not exist'.format(path))
+        df = pd.read_parquet(path,columns=columns,filters=filters)
+        return cls(df)
+
@@ -6,27 +6,32 @@ import sys
 import yaml
 import json
 import glob
+import time
+import threading
 import ROOT
 import argparse
 import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from pprint import pprint
 from tqdm import tqdm
 from copy import copy,deepcopy
 from IPython import embed
 import numpy as np
 import pandas as pd
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib import cm
 
 from .data_helper import Data, Observable
+from .processor import BaseFileProcessor, UprootFileProcessor, Hist2D
+from .cache import ContentCache
+from .render import renderJob, writeSlices
 
 from ..utils.yamlLoader import parseYaml
 from ..utils.environment import getEnv
 from ..utils.context import TFileOpen
 from ..utils.scan_utils import makeScan
 from ..utils.dask_utils import MonitoringLoop
+from ..utils.cluster import makeCluster, availableCores
 from ..utils.logger import Logger
+from ..utils.result_store import ResultStore, INDEX_FILE, normalizeValue, normalizeParams
 
 OBSERVABLES = ['Efficiency',
                'Fire rate',
@@ -42,80 +47,36 @@ RANGES = {'Efficiency'                 : (0.,1.),
           'Previous BX contamination'  : (0.,1.)}
 
 
+# Memory needed to process a single file #
+FILE_MEMORY = '2GiB'
+# Default number of threads reading files (params.json of the results without index, threads mode) #
+IO_THREADS = 16
+# Missing points printed in the summary #
+MAX_MISSING_PRINTED = 50
+
 try:
     ROOT_VERSION = re.split("\.|/",ROOT.__version__)
 except:
     ROOT_VERSION = None
 
-class FileProcessor:
-    def __init__(self,hists,efficiency,firerate,labels):
-        self.hists      = hists
-        self.efficiency = efficiency
-        self.firerate   = firerate
-        self.labels     = labels
-
-    def __call__(self,f):
-        # Open file #
-        if not os.path.exists(f):
-            raise RuntimeError(f'File {f} does not exist')
-        json_path = os.path.join(os.path.dirname(f),'params.json')
-        if not os.path.exists(json_path):
-            raise RuntimeError(f'File {json_path} does not exist')
-        params_json = self._getParametersFromJson(json_path)
-        with TFileOpen(f,'r') as F:
-            # Get file parameters #
-            #params_root = self._getParametersFromTFile(F)
-            #if params_json != params_root:
-            #    raise RuntimeError(f'Difference between parameters in ROOT file {f} ({params_root}) and json {json_path} ({params_json}), this should not happen')
-
-            # Produce efficiency hist#
-            h_eff = self._getEfficiencyHist(F)
-            h_fire = self._getFireRate(F)
-
-            # Loop over each histogram #
-            content = []
-            for name,values in self.hists.items():
-                # Initialize entry #
-                entry = {}
-                for key,val in params_json.items():
-                    if key in self.labels.keys():
-                        key = self.labels[key]
-                    try:
-                        val = float(val)
-                    except ValueError:
-                        pass
-                    entry[key] = val
-                entry.update(values)
-                delay = values['delay']
-
-                # Get efficiency #
-                eff,contNext,contPrev = self._getEfficiencyValues(h_eff,delay)
-                entry['Efficiency'] = eff
-                entry['Next BX contamination'] = contNext
-                entry['Previous BX contamination'] = contPrev
-
-                # Get firerate #
-                entry['Fire rate'] = self._getFireRateValue(h_fire,delay)
-
-                # Get histogram #
-                h = self._getHistogram(F,values['dir'],name)
-
-                # Get content in numpy arrays #
-                e,w,s = self._getHistContent(h)
-
-                # Compute additional info based on histogram #
-                fo,fo_err = self._fracOutHisto(e,w,s)
-                entry['Out-of-time fraction'] = fo
-                entry['Out-of-time fraction error'] = fo_err
-                m,m_err = self._meanHisto(e,w,s)
-                entry['Mean'] = m
-                entry['Mean error'] = m_err
-
-                # Save entry in content #
-                content.append(entry)
-
-        # return #
-        return content
+# Type of the bin contents, from the last letter of the histogram class name #
+ROOT_DTYPES = {
+    'C' : np.int8,
+    'S' : np.int16,
+    'I' : np.int32,
+    'L' : np.int64,
+    'F' : np.float32,
+    'D' : np.float64,
+}
+
+class FileProcessor(BaseFileProcessor):
+    """
+        Reads the histograms with PyROOT
+        -> the bin contents are copied from the histogram buffers at once, not bin by bin
+    """
+    @staticmethod
+    def openFile(f):
+        return TFileOpen(f,'r')
 
     @staticmethod
     def _getHistogram(F,dir_path,name):
@@ -140,75 +101,58 @@ class FileProcessor:
             params[pName] = float(F.Get(pFile).GetTitle())
         return params
 
-    def _getParametersFromJson(self,f):
-        with open(f,'r') as handle:
-            params = json.load(handle)
-        return params
-
-    def _getEfficiencyHist(self,F):
-        h_true = self._getHistogram(F,self.efficiency['dir'],self.efficiency['truth'])
-        h_reco = self._getHistogram(F,self.efficiency['dir'],self.efficiency['reco'])
-        h_eff  = h_reco.Clone("eff")
-        h_eff.Divide(h_true)
-        return h_eff
-
-    def _getFireRate(self,F):
-        h = self._getHistogram(F,self.firerate['dir'],self.firerate['hist'])
-        h_fire = h_reco.ProjectionY("fire",firstxbin=2) # BX = 0 -> no hit
-        h_tot = h_reco.ProjectionY("tot")
-        h_fire.Divide(h_tot)
-        return h_fire
-
     @staticmethod
-    def _getEfficiencyValues(h_eff,delay):
-        # Get the bins we are interested in #
-        bin_delay   = h_eff.GetYaxis().FindBin(delay)
-        bin_center  = h_eff.GetXaxis().FindBin(0)
-        bin_next    = h_eff.GetXaxis().FindBin(1)
-        bin_prev    = h_eff.GetXaxis().FindBin(-1)
-        # Compute values #
-        eff         = h_eff.GetBinContent(bin_center,bin_delay) # Efficiency for this BX
-        contNext    = h_eff.GetBinContent(bin_next,bin_delay)   # Contamination in next BX
-        contPrev    = h_eff.GetBinContent(bin_prev,bin_delay)   # Contamination in previous BX
-        return eff,contNext,contPrev
+    def _getEdges(axis):
+        if axis.GetXbins().GetSize() > 0:
+            return np.frombuffer(axis.GetXbins().GetArray(),dtype=np.float64,count=axis.GetNbins()+1).copy()
+        # Same computation as TAxis::GetBinUpEdge for fixed bins #
+        return axis.GetXmin() + np.arange(axis.GetNbins()+1) * ((axis.GetXmax()-axis.GetXmin())/axis.GetNbins())
 
     @staticmethod
-    def _getFireRateValue(h_fire,delay):
-        return h_fire.GetBinContent(h_fire.GetXaxis().FindBin(delay))
+    def _getContent(h):
+        # All the bins (including under/overflow) in global bin order #
+        dtype = ROOT_DTYPES[h.ClassName()[-1]]
+        return np.frombuffer(h.GetArray(),dtype=dtype,count=h.GetNcells()).copy()
 
     @staticmethod
-    def _getHistContent(h):
-        e = [h.GetXaxis().GetBinUpEdge(0)]
-        w = []
-        s = []
-        for i in range(1,h.GetNbinsX()+1):
-            e.append(h.GetXaxis().GetBinUpEdge(i))
-            w.append(h.GetBinContent(i))
-            s.append(h.GetBinError(i))
-        return np.array(e),np.array(w),np.array(s)
+    def _getErrors(h,content):
+        if h.GetSumw2N() > 0:
+            return np.sqrt(np.frombuffer(h.GetSumw2().GetArray(),dtype=np.float64,count=h.GetNcells()))
+        return np.sqrt(np.abs(content.astype(np.float64)))
 
-    @staticmethod
-    def _fracOutHisto(e,w,s):
-        c = (e[:-1]+e[1:])/2
-        idx = np.delete(np.arange(w.shape[0]),np.abs(c).argmin())
-        return w[idx].sum()/w.sum(),np.sqrt((s[idx]**2).sum())/w.sum()
+    def _getHist2D(self,F,dir_path,name):
+        h = self._getHistogram(F,dir_path,name)
+        # Global bin = x + (nx+2) * y #
+        values = self._getContent(h).reshape(h.GetNbinsY()+2,h.GetNbinsX()+2).T
+        return Hist2D(values,self._getEdges(h.GetXaxis()),self._getEdges(h.GetYaxis()))
 
-    @staticmethod
-    def _meanHisto(e,w,s):
-        c = (e[:-1]+e[1:])/2
-        return (w*c).sum()/w.sum(),np.sqrt(((s*c)**2).sum())/w.sum()
+    def _getHist1D(self,F,dir_path,name):
+        h = self._getHistogram(F,dir_path,name)
+        content = self._getContent(h)
+        errors = self._getErrors(h,content)
+        return self._getEdges(h.GetXaxis()),content[1:-1].astype(np.float64),errors[1:-1]
+
+# Histogram reading backends, uproot does not need ROOT on the workers #
+PROCESSORS = {
+    'root'   : FileProcessor,
+    'uproot' : UprootFileProcessor,
+}
 
 
 
 class PlotScan:
-    def __init__(self,input,output,hists,parameters,labels,observables,efficiency,firerate,mode,force,logger,**kwargs):
+    def __init__(self,input,output,hists,parameters,labels,observables,efficiency,firerate,mode,force,logger,backend=None,plot_workers=None,data_output='files',**kwargs):
         # Attributes #
         self.input          = input
         self.output         = output
         self.labels         = labels
         self.mode           = mode
+        self.threads        = None
+        self.plot_workers   = availableCores() if plot_workers is None else plot_workers
+        self.data_output    = data_output
         self.force          = force
-        self.cache          = os.path.join(getEnv()['paths']['scans'],'cache',f'cache_{self.output}.pkl')
+        self.cache          = os.path.join(getEnv()['paths']['scans'],'cache',f'cache_{self.output}.parquet')
+        self.cacheDir       = os.path.join(getEnv()['paths']['scans'],'cache',self.output)
         self.logger         = logger
 
         # Path #
@@ -237,115 +181,205 @@ class PlotScan:
         self.files = self.getFilePaths()
 
         # Make processor and get content #
-        self.processor = FileProcessor(hists,efficiency,firerate,labels)
+        if self.mode.startswith('threads'):
+            # threads[:N] #
+            try:
+                self.threads = int(self.mode.split(':')[1]) if ':' in self.mode else IO_THREADS
+            except ValueError:
+                raise RuntimeError(f'Mode `{self.mode}` not understood, should be `threads` or `threads:<number of threads>`')
+            if self.threads <= 0:
+                raise RuntimeError('The number of threads must be positive')
+            # PyROOT file reading is not thread-safe #
+            if backend is None:
+                backend = 'uproot'
+            elif backend != 'uproot':
+                raise RuntimeError('The threads mode can only be used with the uproot backend')
+        if backend is None:
+            backend = 'root'
+        if backend not in PROCESSORS.keys():
+            raise RuntimeError(f'Backend `{backend}` not implemented, available backends are : {", ".join(PROCESSORS.keys())}')
+        self.processor = PROCESSORS[backend](hists,efficiency,firerate,labels)
         self.getFullContent()
 
     def getFilePaths(self):
+        # Directory of each point, from the result store index or from the params.json of the results #
+        if os.path.exists(os.path.join(self.path,'results',INDEX_FILE)):
+            store = ResultStore(os.path.join(self.path,'results'),self.logger)
+            lookup = store.find(self.paramNames)
+        else:
+            lookup = self.indexResults()
+        # Direct lookup of each point #
         files = []
-        paramEntries = [{k:v for k,v in zip(self.paramNames,paramValues)} for paramValues in self.paramValues]
-#        print(f"Param. entries:\n{paramEntries}")
-#        print(f"Directories: {glob.glob(os.path.join(self.path,'results','*'))}")
-        for subdir in glob.glob(os.path.join(self.path,'results','*')):
-            if subdir != '/nfs/dust/cms/user/sanjrani/Tracker/SSTC_output/scans/run/thresholdScan/results/0':
+        missing = []
+        for paramValues in self.paramValues:
+            subdir = lookup.get(tuple(normalizeValue(pVal) for pVal in paramValues))
+            if subdir is None:
+                missing.append({k:v for k,v in zip(self.paramNames,paramValues)})
                 continue
-            # get params #
+            rfiles = glob.glob(os.path.join(subdir,'BX*harvested.root'))
+            if len(rfiles) == 0:
+                self.logger.warning(f'ROOT file absent in {subdir}, this might not be expected')
+            elif len(rfiles) == 1:
+                files.append(rfiles[0])
+            else:
+                raise RuntimeError(f'More than one harvested root file in {subdir}, this might lead to bugs')
+        self.checkMissing(missing)
+        return files
+
+    def indexResults(self):
+        # Results without index : the params.json are read concurrently, keyed by the normalized values of the scan parameters #
+        subdirs = sorted([subdir for subdir in glob.glob(os.path.join(self.path,'results','*')) if os.path.isdir(subdir)])
+        def readParams(subdir):
             json_path = os.path.join(subdir,'params.json')
             if not os.path.exists(json_path):
-                self.logger.warning(f'File {json_path} is missing, this might not be expected')
-                continue
+                return None
             with open(json_path,'r') as handle:
-                params = json.load(handle)
-            # get file name if in the parameters #
-            idx = None
-            for i,paramEntry in enumerate(paramEntries):
-                print(f"i: {i}")
-                print(f"paramEntry: {paramEntry}")
-                print(f"paramEntry.items: {paramEntry.items()}")
-                print(f"params.items: {params.items()}")
-                print(f"paramEntry.items <= params.items(): {paramEntry.items() <= params.items()}")
-                if paramEntry.items() <= params.items():
-                    idx = i
-            if idx is not None:
-                # Mark and cleanup for faster loop #
-                print(f"idx: {idx}")
-                print(f"paramEntries: {paramEntries}")
-                print(f"paramEntries[idx]: {paramEntries[idx]}")
-                del paramEntries[idx]
-                print(f"paramEntries: {paramEntries}")
-                print(f"paramEntries[idx]: {paramEntries[idx]}")
-                # get file #
-                rfiles = glob.glob(os.path.join(subdir,'BX*harvested.root'))
-                if len(rfiles) == 0:
-                    self.logger.warning(f'ROOT file absent in {subdir}, this might not be expected')
-                elif len(rfiles) == 1:
-                    files.append(rfiles[0])
-                else:
-                    raise RuntimeError(f'More than one harvested root file in {subdir}, this might lead to bugs')
-                files.append(rfiles[0])
+                return json.load(handle)
+        with ThreadPoolExecutor(max_workers=IO_THREADS) as executor:
+            allParams = list(executor.map(readParams,subdirs))
+        lookup = {}
+        absent = []
+        duplicates = 0
+        for subdir,params in zip(subdirs,allParams):
+            if params is None:
+                absent.append(subdir)
+                continue
+            params = normalizeParams(params)
+            key = tuple(params.get(pName) for pName in self.paramNames)
+            if key in lookup:
+                duplicates += 1
+                continue
+            lookup[key] = subdir
+        if len(absent) > 0:
+            self.logger.warning(f'{len(absent)} result directories without params.json (eg {absent[0]}), this might not be expected')
+        if duplicates > 0:
+            self.logger.warning(f'{duplicates} result directories with the same scan parameters as another one, only the first one is used')
+        self.logger.info(f'Indexed {len(lookup)} result directories')
+        return lookup
+
+    def checkMissing(self,paramEntries):
         if len(paramEntries) > 0:
-            self.logger.warning('Missing parameters :')
-            for paramEntry in paramEntries:
-                self.logger.warning('...')
-                for pName, pVal in paramEntry.items():
-                    self.logger.warning(f'\t{pName:30s} : {pVal}')
+            self.logger.warning(f'Missing {len(paramEntries)} points (out of {len(self.paramValues)}) :')
+            for paramEntry in paramEntries[:MAX_MISSING_PRINTED]:
+                self.logger.warning('... '+', '.join(f'{pName} = {pVal}' for pName,pVal in paramEntry.items()))
+            if len(paramEntries) > MAX_MISSING_PRINTED:
+                self.logger.warning(f'... and {len(paramEntries)-MAX_MISSING_PRINTED} more')
             raise RuntimeError('See missing parameters above')
-        return files
 
     def getFullContent(self):
-        if not os.path.exists(self.cache) or self.force:
-            if self.force:
-                self.logger.info('Forcing recreation of the cache')
-            else:
-                self.logger.info('No cache file present, will process root files')
+        cache = ContentCache(self.cacheDir,self.cache,self.processor.configHash(),self.logger)
+        if self.force:
+            self.logger.info('Forcing recreation of the cache')
+            todo = self.files
+        else:
+            todo = cache.outdated(self.files)
+            self.logger.info(f'{len(self.files)-len(todo)} files found in the cache, {len(todo)} to process')
 
+        if len(todo) > 0:
             # Just check that files are there #
-            for f in self.files:
+            for f in todo:
                 if not os.path.exists(f):
                     self.logger.warning(f'Could not find file : {f}')
 
-            # Serial working #
-            content = []
-            if self.mode == 'worker':
-                for f in tqdm(self.files):
-                    content.extend(self.processor(f))
-            # Parallel working #
-            else:
-                # Start cluster #
-                if self.mode == 'local':
-                    from dask.distributed import LocalCluster
-                    cluster = LocalCluster(n_workers=10,threads_per_worker=1,memory_limit='6GiB',scheduler_port=1234)
-                elif self.mode == 'slurm':
-                    from dask_jobqueue import SLURMCluster
-                    cluster = SLURMCluster()
-                elif self.mode == 'htcondor':
-                    from dask_jobqueue import HTCondorCluster
-                    cluster = HTCondorCluster()
+            # The files saved before an error or interruption are kept in the manifest #
+            try:
+                # Serial working #
+                if self.mode == 'worker':
+                    for f in tqdm(todo):
+                        cache.save(f,self.processor(f))
+                # Thread pool #
+                elif self.threads is not None:
+                    self.processThreads(todo,cache)
+                # Parallel working #
                 else:
-                    raise NotImplementedError(f'Dask mode {args.mode} not implemented')
-                # Start client #
-                from dask.distributed import Client
-                client = Client(cluster)
-                # submit #
-                def func(processor,f):
-                    return processor(f)
-                futures = client.map(func,[self.processor]*len(self.files),self.files)
-                loop = MonitoringLoop(futures,client,cluster,self.logger,20)
-                loop.start(close_at_end=False)
-                if not loop.checkFinished():
-                    raise RuntimeError('Seems like not all futures are finished, this should not happen')
-                # Concatenate (need to find faster) #
-                content = [entry for future in futures for entry in future.result()]
-                loop.close()
-            df = pd.DataFrame(content)
-            df.to_pickle(self.cache)
-            self.logger.info(f'Saved cache in {self.cache}')
-        else:
-            df = pd.read_pickle(self.cache)
-            self.logger.info(f'Loaded cache from {self.cache}')
+                    self.processDask(todo,cache)
+            finally:
+                cache.saveManifest()
+        # Only the plotted observables (and their errors, dropped by the cache if absent) and the values of the scan are loaded #
+        parameters = list(self.labels.values()) + ['delay']
+        columns = parameters + self.observables + [f'{obs} error' for obs in self.observables]
+        df = cache.load(self.files,parameters,columns=columns,selection=self.getSelection())
         self.logger.info('Producing data object from the pandas DataFrame')
-        self.data = Data(df)
+        # The observable cube is memory-mapped next to the cache, and reused while the content does not change #
+        self.data = Data(df,cube_path=os.path.join(self.cacheDir,'cube'))
         self.logger.info('... done')
-        self.data.SetParameters(list(self.labels.values()) + ['delay'])
+        self.data.SetParameters(parameters)
+
+    def processDask(self,files,cache):
+        # Start cluster #
+        cluster = makeCluster(self.mode,self.logger,FILE_MEMORY,len(files))
+        # Start client #
+        from dask.distributed import Client
+        client = Client(cluster)
+        # submit #
+        def func(processor,f):
+            return processor(f)
+        futures = client.map(func,[self.processor]*len(files),files)
+        # Each result is saved in the cache as soon as it is done (callbacks run in a separate thread) #
+        keyFiles = {future.key:f for f,future in zip(files,futures)}
+        handled = {future.key:threading.Event() for future in futures}
+        def saveResult(future):
+            try:
+                if future.status == 'finished':
+                    cache.save(keyFiles[future.key],future.result())
+            except Exception as e:
+                self.logger.error(f'Could not save {keyFiles[future.key]} in the cache : {e}')
+            finally:
+                handled[future.key].set()
+        for future in futures:
+            future.add_done_callback(saveResult)
+        loop = MonitoringLoop(futures,client,cluster,self.logger,20)
+        loop.start(close_at_end=False)
+        if not loop.checkFinished():
+            raise RuntimeError('Seems like not all futures are finished, this should not happen')
+        for event in handled.values():
+            event.wait()
+        # Futures retried after a failure do not call the callback again #
+        for f,future in zip(files,futures):
+            if not cache.isValid(f):
+                cache.save(f,future.result())
+        loop.close()
+
+    def processThreads(self,files,cache):
+        # At most one file read per thread at a time, the content is saved in the cache as soon as a file is done (and kept if interrupted) #
+        def func(f):
+            start = time.time()
+            content = self.processor(f)
+            return content,time.time()-start
+        timings = {}
+        self.logger.info(f'Processing {len(files)} files with {self.threads} threads')
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            futures = {executor.submit(func,f):f for f in files}
+            try:
+                for future in tqdm(as_completed(futures),total=len(futures)):
+                    f = futures[future]
+                    content,timings[f] = future.result()
+                    cache.save(f,content)
+                    self.logger.debug(f'Processed {f} in {timings[f]:.2f}s')
+            except BaseException:
+                # Do not process the remaining files, and keep the finished ones in the manifest #
+                for future in futures:
+                    future.cancel()
+                cache.saveManifest()
+                raise
+        slowest = max(timings,key=timings.get)
+        times = np.array(list(timings.values()))
+        self.logger.info(f'Time per file : {times.mean():.2f}s on average, {np.median(times):.2f}s median, {times.max():.2f}s max ({slowest})')
+
+    def getSelection(self):
+        # Values of each scan parameter, with the column names and types of the dataframe #
+        selection = {}
+        for i,pName in enumerate(self.paramNames):
+            values = []
+            for paramValues in self.paramValues:
+                try:
+                    val = float(paramValues[i])
+                except ValueError:
+                    val = str(paramValues[i])
+                if val not in values:
+                    values.append(val)
+            selection[self.labels.get(pName,pName)] = values
+        return selection
 
 
     def Plots(self):
@@ -355,66 +389,72 @@ class PlotScan:
             os.makedirs(path_plots)
         if not os.path.exists(path_data):
             os.makedirs(path_data)
+        if self.data_output not in ['files','single']:
+            raise RuntimeError(f'Unknown data output `{self.data_output}`, must be files or single')
+        jobs = []
+        outputs = {}
         for obsName in self.observables:
             observable = self.data.GetObservable(obsName)
             for param in self.labels.values():
-                self.logger.info(f"Plotting {obsName} curves of {param} parameter")
                 output_plots_dir = os.path.join(path_plots,f'curves_{obsName}_{param}'.replace(' ',''))
                 output_data_dir = os.path.join(path_data,f'curves_{obsName}_{param}'.replace(' ',''))
                 if not os.path.exists(output_plots_dir):
                     os.makedirs(output_plots_dir)
-                if not os.path.exists(output_data_dir):
+                # Single ROOT file per observable and parameter, the slices are added in the loop below #
+                if self.data_output == 'single':
+                    output_data_file = f'{output_data_dir}.root'
+                    outputs[output_data_file] = []
+                    output_data_dir = None
+                elif not os.path.exists(output_data_dir):
                     os.makedirs(output_data_dir)
 
                 labels_to_vary = {key:observable.GetLabels()[key] for key in observable.GetLabels().keys() if key != param and key != 'delay'}
 
+                # One independent render job per slice #
                 for comb in itertools.product(*list(labels_to_vary.values())):
                     varied_labels = {k:c for k,c in zip(labels_to_vary.keys(),comb)}
-                    obs2d = observable.GetSlice(**varied_labels)
-                    data_dict = {'2D':obs2d.GetRootTGraph2D(x='delay',y=param)}
-                    fig_name = f'{"_".join([f"{p}_{v}" for p,v in varied_labels.items()])}'.replace(' ','_')
-
-                    # Plot 1D #
-                    fig, ax = plt.subplots(figsize=(8,7))
-                    plt.subplots_adjust(left=0.15, right=0.90, top=0.85, bottom=0.12)
-                    paramValues = obs2d.GetLabels()[param]
-                    colors = cm.jet(np.linspace(0,1,paramValues.shape[0]))
-                    for paramVal,color in zip(paramValues,colors):
-                        obs1d = obs2d.GetSlice(**{param:paramVal})
-                        obs1d.Pyplot1D(ax,color=color)
-                        data_dict[f'1D_{param}_{paramVal}'] = obs1d.GetRootTGraph()
-                    sm = cm.ScalarMappable(cmap=cm.rainbow, norm=plt.Normalize(vmin=paramValues.min(), vmax=paramValues.max()))
-                    cbar = plt.colorbar(sm,ax=ax)
-                    cbar.set_label(param,fontsize=18,labelpad=20)
-                    cbar.ax.tick_params(labelsize=14)
-                    plt.xlabel('Delay [ns]',fontsize=18,labelpad=20)
-                    plt.ylabel(obsName,fontsize=18,labelpad=10)
-                    plt.ylim(self.ranges[obsName])
-                    title = f'{param} curves\n({", ".join([f"{p} = {v}" for p,v in varied_labels.items()])})'
-                    plt.title(title,fontsize=20,pad=25)
-                    plt.tick_params(axis='both', which='major', labelsize=14)
-                    self.logger.info('... '+title.replace("\n"," : "))
-                    fig.savefig(f'{os.path.join(output_plots_dir,fig_name)}_1D.png')
-                    plt.close()
-
-                    # Plot 2D #
-                    fig,ax = plt.subplots(figsize=(8,7))
-                    plt.subplots_adjust(left=0.17, right=0.95, top=0.85, bottom=0.1)
-                    obs2d.Pyplot2D(x='delay',y=param, ax=ax, vmin=self.ranges[obsName][0], vmax=self.ranges[obsName][1], shading='auto', linewidth=0,rasterized=True)
-                    cbar = fig.colorbar(ax.collections[0],ax=ax)
-                    cbar.set_label(obsName,fontsize=18,labelpad=20)
-                    cbar.ax.tick_params(labelsize=14)
-                    ax.set_xlabel('Delay [ns]',fontsize=18,labelpad=10)
-                    ax.set_ylabel(param,fontsize=18,labelpad=20)
-                    ax.set_title(title,fontsize=20,pad=25)
-                    ax.tick_params(axis='both', which='major', labelsize=14)
-                    fig.savefig(f'{os.path.join(output_plots_dir,fig_name)}_2D.png')
-                    plt.close()
-
-                    # Save in ROOT file #
-                    with TFileOpen(f'{os.path.join(output_data_dir,fig_name)}.root','w') as F:
-                        for name,obj in data_dict.items():
-                            obj.Write(name)
+                    job = {
+                        'obs2d'         : observable.GetSlice(**varied_labels),
+                        'obsName'       : obsName,
+                        'param'         : param,
+                        'varied_labels' : varied_labels,
+                        'obsRange'      : self.ranges[obsName],
+                        'plots_dir'     : output_plots_dir,
+                        'data_dir'      : output_data_dir,
+                    }
+                    jobs.append(job)
+                    if output_data_dir is None:
+                        outputs[output_data_file].append(job)
+        self.renderJobs(jobs,outputs)
+
+    def renderJobs(self,jobs,outputs=None):
+        # Serial, or in a process pool (each job writes its own files) #
+        # The single ROOT files (path -> jobs) are written by this process, while the pool renders the plots #
+        outputs = {} if outputs is None else outputs
+        n_workers = max(1,min(self.plot_workers,len(jobs)))
+        self.logger.info(f'Rendering {len(jobs)} slices with {n_workers} processes')
+        if n_workers == 1:
+            for job in tqdm(jobs):
+                title = renderJob(job)
+                self.logger.debug('... '+title.replace("\n"," : "))
+            self.writeOutputs(outputs)
+            return
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(renderJob,job) for job in jobs]
+            try:
+                self.writeOutputs(outputs)
+                for future in tqdm(as_completed(futures),total=len(futures)):
+                    title = future.result()
+                    self.logger.debug('... '+title.replace("\n"," : "))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def writeOutputs(self,outputs):
+        for path,jobs in outputs.items():
+            writeSlices(path,jobs)
+            self.logger.info(f'Saved {len(jobs)} slices in {path}')
 
 def main():
     parser = argparse.ArgumentParser(description='Produce datacards')
@@ -431,9 +471,15 @@ def main():
     parser.add_argument('-v','--verbose', action='store_true', required=False, default=False,
                         help='Verbose mode')
     parser.add_argument('--cache', action='store_true', required=False, default=False,
-                        help='Force recreation of the cache (and no plots)')
+                        help='Force reprocessing of all the files in the cache (and no plots), by default only new or modified files are processed')
     parser.add_argument('--mode',action='store',required=False,type=str,default='worker',
-                        help='Processing mode : worker (in series) or dask modes = local | slurm | htcondor')
+                        help='Processing mode : worker (in series), threads[:N] (thread pool of N threads on this node, uproot backend) or dask modes = local | slurm | htcondor')
+    parser.add_argument('--backend',action='store',required=False,type=str,default=None,choices=['root','uproot'],
+                        help='Library used to read the histograms : root (PyROOT) or uproot (no ROOT import on the workers) [default = uproot in threads mode, root otherwise]')
+    parser.add_argument('--plot-workers',action='store',required=False,type=int,default=None,
+                        help='Number of processes rendering the plots [default = available cores]')
+    parser.add_argument('--data-output',action='store',required=False,type=str,default='files',choices=['files','single'],
+                        help='ROOT output of the slices : files (one file per slice) or single (one file per observable and parameter, one directory per slice) [default = files]')
     args = parser.parse_args()
 
     # Make logger #
@@ -443,7 +489,7 @@ def main():
         raise RuntimeError("Must provide the YAML file")
     f = parseYaml(args.yaml,args.custom)
 
-    instance = PlotScan(**f,input=args.input,output=args.output,mode=args.mode,force=args.cache,observables=args.observables,logger=logger)
+    instance = PlotScan(**f,input=args.input,output=args.output,mode=args.mode,backend=args.backend,plot_workers=args.plot_workers,data_output=args.data_output,force=args.cache,observables=args.observables,logger=logger)
     if not args.cache:
         instance.Plots()
 
@@ -0,0 +1,188 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+class Hist2D:
+    """
+        Content of a 2D histogram as numpy arrays
+        -> values include the underflow and overflow bins, indexed [x bin, y bin] as in ROOT
+    """
+    def __init__(self,values,xedges,yedges):
+        self.values = values
+        self.xedges = xedges
+        self.yedges = yedges
+
+    @staticmethod
+    def findBin(edges,x):
+        # Same convention as TAxis::FindBin : 0 for underflow, len(edges) for overflow (works on arrays) #
+        return np.searchsorted(edges,x,side='right')
+
+
+class BaseFileProcessor:
+    """
+        Extracts the observables of a harvested file, one entry per BX histogram
+        -> the backends (PyROOT or uproot) only read the histograms as numpy arrays
+        -> the observables are computed for all the delays at once, on the (histogram x BX) matrix
+    """
+    def __init__(self,hists,efficiency,firerate,labels):
+        self.hists      = hists
+        self.efficiency = efficiency
+        self.firerate   = firerate
+        self.labels     = labels
+
+    def __call__(self,f):
+        # Open file #
+        if not os.path.exists(f):
+            raise RuntimeError(f'File {f} does not exist')
+        json_path = os.path.join(os.path.dirname(f),'params.json')
+        if not os.path.exists(json_path):
+            raise RuntimeError(f'File {json_path} does not exist')
+        params_json = self._getParametersFromJson(json_path)
+        with self.openFile(f) as F:
+            # Produce efficiency and firerate maps #
+            h_eff = self._getEfficiencyHist(F)
+            h_fire = self._getFireRate(F)
+            # Get content of all the histograms #
+            e,w,s = self._getHistContents(F)
+
+        # Compute observables for all delays at once #
+        delays = np.array([values['delay'] for values in self.hists.values()],dtype=np.float64)
+        eff,contNext,contPrev = self._getEfficiencyValues(h_eff,delays)
+        fire = self._getFireRateValue(h_fire,delays)
+        fo,fo_err = self._fracOutHisto(e,w,s)
+        m,m_err = self._meanHisto(e,w,s)
+
+        # Make one entry per histogram #
+        params_entry = self._makeEntry(params_json)
+        content = []
+        for i,values in enumerate(self.hists.values()):
+            entry = {**params_entry,**values}
+            entry['Efficiency'] = float(eff[i])
+            entry['Next BX contamination'] = float(contNext[i])
+            entry['Previous BX contamination'] = float(contPrev[i])
+            entry['Fire rate'] = float(fire[i])
+            entry['Out-of-time fraction'] = float(fo[i])
+            entry['Out-of-time fraction error'] = float(fo_err[i])
+            entry['Mean'] = float(m[i])
+            entry['Mean error'] = float(m_err[i])
+            content.append(entry)
+
+        # return #
+        return content
+
+    def configHash(self):
+        # The entries of a file only depend on this configuration (not on the backend) #
+        config = {
+            'hists'      : self.hists,
+            'efficiency' : self.efficiency,
+            'firerate'   : self.firerate,
+            'labels'     : self.labels,
+        }
+        return hashlib.sha1(json.dumps(config,sort_keys=True,default=str).encode()).hexdigest()[:16]
+
+    def _makeEntry(self,params_json):
+        entry = {}
+        for key,val in params_json.items():
+            if isinstance(val,(list,dict)):
+                # Production metadata (eg shard layout), not a parameter #
+                continue
+            if key in self.labels.keys():
+                key = self.labels[key]
+            try:
+                val = float(val)
+            except ValueError:
+                pass
+            entry[key] = val
+        return entry
+
+    @staticmethod
+    def _getParametersFromJson(f):
+        with open(f,'r') as handle:
+            params = json.load(handle)
+        return params
+
+    def _getEfficiencyHist(self,F):
+        h_true = self._getHist2D(F,self.efficiency['dir'],self.efficiency['truth'])
+        h_reco = self._getHist2D(F,self.efficiency['dir'],self.efficiency['reco'])
+        # Empty bins of the denominator give 0, as in TH1::Divide (computed in double, stored in the histogram type) #
+        reco = h_reco.values.astype(np.float64)
+        true = h_true.values.astype(np.float64)
+        values = np.divide(reco,true,out=np.zeros(reco.shape),where=true!=0).astype(h_reco.values.dtype)
+        return Hist2D(values,h_reco.xedges,h_reco.yedges)
+
+    def _getFireRate(self,F):
+        h_reco = self._getHist2D(F,self.firerate['dir'],self.firerate['reco'])
+        # Y projections from the second X bin (BX = 0 -> no hit) and over all X bins, including overflows #
+        values = h_reco.values.astype(np.float64)
+        fire = values[2:,:].sum(axis=0)
+        tot = values.sum(axis=0)
+        values = np.divide(fire,tot,out=np.zeros(fire.shape),where=tot!=0)
+        return values,h_reco.yedges
+
+    def _getHistContents(self,F):
+        # Stacked as (histogram x BX) matrices #
+        contents = [self._getHist1D(F,values['dir'],name) for name,values in self.hists.items()]
+        if len(set(len(c[0]) for c in contents)) > 1:
+            raise RuntimeError('All the BX histograms must have the same number of bins')
+        return tuple(np.stack(arrays) for arrays in zip(*contents))
+
+    @staticmethod
+    def _getEfficiencyValues(h_eff,delays):
+        # Get the bins we are interested in #
+        bin_delay   = Hist2D.findBin(h_eff.yedges,delays)
+        bin_center  = Hist2D.findBin(h_eff.xedges,0)
+        bin_next    = Hist2D.findBin(h_eff.xedges,1)
+        bin_prev    = Hist2D.findBin(h_eff.xedges,-1)
+        # Compute values #
+        eff         = h_eff.values[bin_center,bin_delay] # Efficiency for this BX
+        contNext    = h_eff.values[bin_next,bin_delay]   # Contamination in next BX
+        contPrev    = h_eff.values[bin_prev,bin_delay]   # Contamination in previous BX
+        return eff,contNext,contPrev
+
+    @staticmethod
+    def _getFireRateValue(h_fire,delays):
+        values,edges = h_fire
+        return values[Hist2D.findBin(edges,delays)]
+
+    @staticmethod
+    def _fracOutHisto(e,w,s):
+        # Fraction outside of the bin closest to 0, for each row #
+        c = (e[:,:-1]+e[:,1:])/2
+        out = np.ones(w.shape,dtype=bool)
+        out[np.arange(w.shape[0]),np.abs(c).argmin(axis=1)] = False
+        tot = w.sum(axis=1)
+        return np.where(out,w,0.).sum(axis=1)/tot,np.sqrt(np.where(out,s**2,0.).sum(axis=1))/tot
+
+    @staticmethod
+    def _meanHisto(e,w,s):
+        c = (e[:,:-1]+e[:,1:])/2
+        tot = w.sum(axis=1)
+        return (w*c).sum(axis=1)/tot,np.sqrt(((s*c)**2).sum(axis=1))/tot
+
+
+class UprootFileProcessor(BaseFileProcessor):
+    """
+        Reads the histograms with uproot
+        -> does not import ROOT, so that the workers do not pay its import time and memory
+    """
+    @staticmethod
+    def openFile(f):
+        import uproot
+        return uproot.open(f)
+
+    @staticmethod
+    def _getHistogram(F,dir_path,name):
+        try:
+            return F[f'{dir_path}/{name}']
+        except KeyError:
+            raise RuntimeError(f'Could not find histogram `{name}` in `{dir_path}` in file `{F.file_path}`')
+
+    def _getHist2D(self,F,dir_path,name):
+        h = self._getHistogram(F,dir_path,name)
+        return Hist2D(h.values(flow=True),h.axis(0).edges(),h.axis(1).edges())
+
+    def _getHist1D(self,F,dir_path,name):
+        h = self._getHistogram(F,dir_path,name)
+        return np.asarray(h.axis().edges(),dtype=np.float64),np.asarray(h.values(),dtype=np.float64),np.asarray(h.errors(),dtype=np.float64)
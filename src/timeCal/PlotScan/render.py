@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib import cm
+
+from ..utils.context import TFileOpen
+
+# Figures created once per process, and cleared for each plot #
+FIGURES = {}
+
+def getFigure(kind):
+    if kind not in FIGURES:
+        FIGURES[kind] = plt.figure(figsize=(8,7))
+    fig = FIGURES[kind]
+    fig.clf()
+    return fig
+
+def sliceName(varied_labels):
+    # Name of the files (or directory) of a slice #
+    return f'{"_".join([f"{p}_{v}" for p,v in varied_labels.items()])}'.replace(' ','_')
+
+def getRootObjects(obs2d,param):
+    # TGraph2D of the slice, and TGraph of each curve #
+    data_dict = {'2D':obs2d.GetRootTGraph2D(x='delay',y=param)}
+    for paramVal,g in obs2d.GetRootTGraphs(x='delay',y=param).items():
+        data_dict[f'1D_{param}_{paramVal}'] = g
+    return data_dict
+
+def renderSlice(obs2d,obsName,param,varied_labels,obsRange,plots_dir,data_dir):
+    """
+        Produces the plots and ROOT file of a 2D slice (delay x param) of an observable
+        Input :
+            - obs2d [Observable] : 2D slice of the observable
+            - obsName [str] : name of the observable
+            - param [str] : parameter of the curves
+            - varied_labels [dict] : values of the other parameters for this slice
+            - obsRange [tuple] : range of the observable
+            - plots_dir [str] : directory of the png files
+            - data_dir [str] : directory of the ROOT file (None if the slices are written together, see writeSlices)
+        Return :
+            - [str] : title of the plots
+        Only depends on its inputs, so that the slices can be rendered in any order and process
+    """
+    fig_name = sliceName(varied_labels)
+    title = f'{param} curves\n({", ".join([f"{p} = {v}" for p,v in varied_labels.items()])})'
+
+    # Plot 1D #
+    fig = getFigure('1D')
+    ax = fig.add_subplot()
+    fig.subplots_adjust(left=0.15, right=0.90, top=0.85, bottom=0.12)
+    paramValues = obs2d.GetLabels()[param]
+    colors = cm.jet(np.linspace(0,1,paramValues.shape[0]))
+    for paramVal,color in zip(paramValues,colors):
+        obs2d.GetSlice(**{param:paramVal}).Pyplot1D(ax,color=color)
+    sm = cm.ScalarMappable(cmap=cm.rainbow, norm=plt.Normalize(vmin=paramValues.min(), vmax=paramValues.max()))
+    cbar = fig.colorbar(sm,ax=ax)
+    cbar.set_label(param,fontsize=18,labelpad=20)
+    cbar.ax.tick_params(labelsize=14)
+    ax.set_xlabel('Delay [ns]',fontsize=18,labelpad=20)
+    ax.set_ylabel(obsName,fontsize=18,labelpad=10)
+    ax.set_ylim(obsRange)
+    ax.set_title(title,fontsize=20,pad=25)
+    ax.tick_params(axis='both', which='major', labelsize=14)
+    fig.savefig(f'{os.path.join(plots_dir,fig_name)}_1D.png')
+
+    # Plot 2D #
+    fig = getFigure('2D')
+    ax = fig.add_subplot()
+    fig.subplots_adjust(left=0.17, right=0.95, top=0.85, bottom=0.1)
+    obs2d.Pyplot2D(x='delay',y=param, ax=ax, vmin=obsRange[0], vmax=obsRange[1], shading='auto', linewidth=0,rasterized=True)
+    cbar = fig.colorbar(ax.collections[0],ax=ax)
+    cbar.set_label(obsName,fontsize=18,labelpad=20)
+    cbar.ax.tick_params(labelsize=14)
+    ax.set_xlabel('Delay [ns]',fontsize=18,labelpad=10)
+    ax.set_ylabel(param,fontsize=18,labelpad=20)
+    ax.set_title(title,fontsize=20,pad=25)
+    ax.tick_params(axis='both', which='major', labelsize=14)
+    fig.savefig(f'{os.path.join(plots_dir,fig_name)}_2D.png')
+
+    # Save in ROOT file #
+    if data_dir is not None:
+        with TFileOpen(f'{os.path.join(data_dir,fig_name)}.root','w') as F:
+            for name,obj in getRootObjects(obs2d,param).items():
+                obj.Write(name)
+
+    return title
+
+def writeSlices(path,jobs):
+    """
+        Writes the ROOT objects of several slices in a single file, opened once
+        Input :
+            - path [str] : path of the ROOT file
+            - jobs [list] : render jobs of the slices (see renderSlice)
+        Return : None
+        -> one directory per slice, named as the files of the slice and titled with the values of the other parameters
+        -> a slice without other parameters is written at the top of the file
+    """
+    with TFileOpen(path,'w') as F:
+        for job in jobs:
+            name = sliceName(job['varied_labels'])
+            if len(name) == 0:
+                directory = F
+            else:
+                directory = F.mkdir(name,", ".join([f"{p} = {v}" for p,v in job['varied_labels'].items()]))
+            directory.cd()
+            for objName,obj in getRootObjects(job['obs2d'],job['param']).items():
+                obj.Write(objName)
+
+def renderJob(job):
+    # Single argument for the process pool #
+    return renderSlice(**job)
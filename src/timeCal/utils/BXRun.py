@@ -4,7 +4,11 @@ import copy
 import json
 import yaml
 import math
+import time
+import socket
 import glob
+import shutil
+import hashlib
 import functools
 import itertools
 import argparse
@@ -19,32 +23,86 @@ from .dask_utils import MonitoringLoop
 from .logger import Logger
 from .yamlLoader import parseYaml
 from .scan_utils import makeScan
-
-DEFAULT_PARAMS = {
-    'N'                  : 1,
-    'pileup'             : 200,
-    'pt'                 : 2.,
-    'threshold'          : 5800,
-    'thresholdsmearing'  : 0.,
-    'tofsmearing'        : 0.,
-    'mode'               : 'scan',
-    'subdet'             : 'ALL',
-    'offset'             : -1.,
-    'verbose'            : 0,
-}
+from .result_store import ResultStore, DEFAULT_PARAMS, OPTIONAL_PARAMS, paramHash, paramSeed, normalizeValue
+from .ledger import Ledger, LEDGER_FILE, taskKey
+from .cmssw_env import getCMSSWEnv
+from .cluster import makeCluster, localWorkers, taskMemory
+from .pool import PoolClient
+from .telemetry import CmsRunProgress, parseJobReport
 
 SETUP_CMSSW = getEnv()['cmssw']['init']
+CMSSW_ENV_CACHE = getEnv()['cmssw'].get('cache',None)
 CMSSW_DIR = os.path.join(getEnv()['paths']['cmssw'])
 HARVESTER_SCRIPT = 'Harvester_cfg.py'
+DQM_SAVER_FILE = 'DQM_V0001_R000000001__Global__CMSSW_X_Y_Z__RECO.root'
+JOB_REPORT_FILE = 'jobreport.xml'
 OUTPUT_DIR = getEnv()['paths']['production']
+# Memory of a task if not known from the ledger of previous attempts #
+DEFAULT_TASK_MEMORY = 6 * 1024**3
+
+# Parameters that change the simulated hits (the others only change the hit detection) #
+DUMP_PARAMS = ['N','pileup','HSfile','PUfile']
+HIT_DUMP_FILE = 'hits.root'
+PREMIX_FILE = 'premix.root'
+# Parameters that only change the analyzer, several of them can share the same mixing #
+ANALYZER_PARAMS = ['threshold','thresholdsmearing','tofsmearing','pt','subdet']
+
+def makeHistFileName(params):
+    # Same naming as the scan mode of PUCalibration_cfg.py #
+    filename = 'BXHistScan_subdet_{:s}_N_{:d}_pileup_{:d}_pt_{:.01f}_threshold_{:d}_thresholdsmearing_{:0.1f}_tofsmearing_{:0.1f}_harvested'.format(
+                    str(params['subdet']),
+                    int(params['N']),
+                    int(params['pileup']),
+                    float(params['pt']),
+                    int(float(params['threshold'])),
+                    float(params['thresholdsmearing']),
+                    float(params['tofsmearing']))
+    return filename.replace('.','p')+'.root'
+
+def dumpParams(param):
+    # Parameters of a hit dump or premixed library, each replica gets its own so that the replicas are independent #
+    params = {k:v for k,v in param.items() if k in DUMP_PARAMS}
+    if normalizeValue(param.get('replica',OPTIONAL_PARAMS['replica'])) != normalizeValue(OPTIONAL_PARAMS['replica']):
+        params['replica'] = param['replica']
+    return params
+
+def shardLayout(N,nshards):
+    # Same split of the events as PUCalibration_cfg.py #
+    return [{'shard': i, 'N': N // nshards + (1 if i < N % nshards else 0)} for i in range(nshards)]
+
+def shardInputs(params,layout):
+    # Same split of the input files as PUCalibration_cfg.py : distinct subsets if there are enough files, distinct event ranges otherwise #
+    if 'premixfile' in params:
+        files = [params['premixfile']]
+    else:
+        with open(params['HSfile'],'r') as handle:
+            files = [line.strip() for line in handle if len(line.strip()) > 0]
+    nshards = len(layout)
+    N = sum(shard['N'] for shard in layout)
+    for shard in layout:
+        i = shard['shard']
+        if nshards > 1 and len(files) >= nshards:
+            shard['files'] = files[i::nshards]
+        else:
+            shard['skip'] = i * (N // nshards) + min(i,N % nshards)
+    return layout
+
+def runTask(task,*args,requires=None,**kwargs):
+    # Only the report is sent back (not the task and its logger), it is recorded in the ledger by the client #
+    # `requires` only holds the result of the tasks that must be done before (eg premix library) #
+    return task(*args,**kwargs).report
 
 class Task:
-    def __init__(self,script,subdir,params,worker=False,verbose=False):
+    def __init__(self,script,subdir,params,worker=False,verbose=False,lean=False):
         self.script = os.path.join(CMSSW_DIR,script)
+        self.lean = lean
         if not os.path.exists(self.script):
             raise RuntimeError(f'Cannot find script {self.script}')
         self.params = {**DEFAULT_PARAMS,**params}
-        self.params = {k,str(v) for k,v in self.params.items()} # Make them strings for easier comparison later
+        self.params = {k:str(v) for k,v in self.params.items()} # Make them strings for easier comparison later
+        # Seed derived from the parameters, recorded with them in params.json and the ROOT file #
+        if 'seed' not in self.params:
+            self.params['seed'] = str(paramSeed(self.params))
         if os.path.isabs(subdir):
             self.subdir = subdir
         else:
@@ -52,10 +110,22 @@ class Task:
         if not os.path.exists(self.subdir):
             os.makedirs(self.subdir)
         self.logger = Logger('Task','debug' if (verbose or worker) else 'info','both' if worker else 'file',self.subdir)
-        if len(glob.glob(os.path.join(self.subdir,'BXHist*_harvested.root'))) > 0:
+        self.report = {'subdir':self.subdir,'host':socket.gethostname(),'start':time.time(),'skipped':False,'outputs':{},'seed':self.params['seed']}
+        if self.isDone():
             self.logger.warning(f'Already harvested ROOT files in {self.subdir}')
+            self.report['skipped'] = True
         else:
-            self.run()
+            try:
+                self.run()
+            except Exception as e:
+                # Sent back with the exception, so that the failure can be recorded #
+                self.report['end'] = time.time()
+                e.report = self.report
+                raise
+        self.report['end'] = time.time()
+
+    def isDone(self):
+        return len(glob.glob(os.path.join(self.subdir,'BXHist*_harvested.root'))) > 0
 
     @staticmethod
     def in_virtualenv():
@@ -81,14 +151,25 @@ class Task:
             env['PATH'] = orig_path.replace(virtual_env_prefix, '')
         return env
 
+    @property
+    def cmssw_env(self):
+        # Captured once per process (and optionally cached on disk), commands are then run without shell #
+        return getCMSSWEnv(CMSSW_DIR,SETUP_CMSSW,self.get_env(),CMSSW_ENV_CACHE)
 
     def run(self):
-        args = [f"{k}={v}" for k,v in self.params.items()]
+        hist_file = self.produce()
+        self.saveParameters(self.subdir,hist_file,self.params)
+
+    def produce(self,extra_args=[]):
+        args = [f"{k}={v}" for k,v in self.params.items()] + extra_args
+        if self.lean:
+            args.append('lean=1')
         self.logger.info('Starting the DQM file production')
         self.logger.info('Arguments : '+' '.join(args))
-        dqm_cmd = self.format_command(['cmsRun',self.script] + args, wdir=self.subdir)
-        self.logger.debug(f'Command: {dqm_cmd}')
-        rc,output = self.run_command(dqm_cmd,return_output=True,shell=True,env=self.get_env())
+        dqm_cmd = ['cmsRun','-j',os.path.join(self.subdir,JOB_REPORT_FILE),self.script] + args
+        self.logger.debug(f'Command: {" ".join(dqm_cmd)}')
+        rc,output = self.timed_command('cmsrun',dqm_cmd,return_output=True,cwd=self.subdir,env=self.cmssw_env)
+        self.readJobReport()
         self.logger.info(f'... exit code : {rc}')
         if rc != 0:
             msg = "Failed to produce the DQM root file :\n"
@@ -108,15 +189,25 @@ class Task:
             raise RuntimeError(f"Wrong output root file : {dqm_file}")
         else:
             dqm_file = os.path.join(self.subdir,dqm_file)
+        hist_file = dqm_file.replace('raw','harvested')
+
+        if self.lean:
+            # Histograms saved by the production job itself, no harvesting needed #
+            saved_file = os.path.join(self.subdir,DQM_SAVER_FILE)
+            if not os.path.exists(saved_file):
+                raise RuntimeError(f"DQM saver file {saved_file} not present")
+            os.replace(saved_file,hist_file)
+            self.logger.info(f"DQM histograms saved as {hist_file}")
+            return hist_file
 
         self.logger.info(f"DQM root file created as {dqm_file}")
         if not os.path.exists(dqm_file):
             raise RuntimeError("DQM root file not present")
 
         self.logger.info('Starting harvesting')
-        harvest_cmd = self.format_command(['cmsRun',os.path.join(CMSSW_DIR,HARVESTER_SCRIPT),f'input={dqm_file}'],wdir=self.subdir)
-        self.logger.debug(f'Command: {harvest_cmd}')
-        rc = self.run_command(harvest_cmd,shell=True,env=self.get_env())
+        harvest_cmd = ['cmsRun',os.path.join(CMSSW_DIR,HARVESTER_SCRIPT),f'input={dqm_file}']
+        self.logger.debug(f'Command: {" ".join(harvest_cmd)}')
+        rc,output = self.timed_command('harvest',harvest_cmd,return_output=True,cwd=self.subdir,env=self.cmssw_env)
 
         self.logger.info(f'... exit code : {rc}')
         if rc != 0:
@@ -126,59 +217,72 @@ class Task:
             raise RuntimeError(msg)
 
         self.logger.info('Starting renaming')
-        hist_file = dqm_file.replace('raw','harvested')
-        dirname = os.path.dirname(dqm_file)
-        rename_cmd = ['mv',os.path.join(self.subdir,'DQM_V0001_R000000001__Global__CMSSW_X_Y_Z__RECO.root'),hist_file]
-        rc = self.run_command(rename_cmd)
-        if rc != 0:
-            raise RuntimeError("Could not rename the harvested file")
-        self.logger.info(f'... exit code : {rc}')
+        os.replace(os.path.join(self.subdir,DQM_SAVER_FILE),hist_file)
         self.logger.info(f'Renamed to {hist_file}')
 
         self.logger.info ('Starting cleaning')
-        clean_cmd = ['rm', dqm_file]
-        rc = self.run_command(clean_cmd)
-        if rc != 0:
-            raise RuntimeError("Could note clean intermediate root file")
-        self.logger.info (f'... exit code : {rc}')
+        os.remove(dqm_file)
+        self.logger.info (f'Removed {dqm_file}')
+        return hist_file
+
+        # Save logger #
+        #log_file = os.path.join(self.subdir,'log.out')
+        #self.logger.info(f'Saved log in {log_file}')
+        #self.logger.write(log_file)
 
+    def saveParameters(self,subdir,hist_file,params):
         # Save parameters in json #
-        param_file = os.path.join(self.subdir,'params.json')
+        param_file = os.path.join(subdir,'params.json')
         with open(param_file,'w') as handle:
-            json.dump(self.params,handle,indent=4)
+            json.dump(params,handle,indent=4)
         self.logger.info(f'Saved parameters to {param_file}')
 
         # Save parameters in root file #
         F = ROOT.TFile(hist_file,"UPDATE")
-        for name,arg in self.params.items():
+        for name,arg in params.items():
             p = ROOT.TNamed(name,str(arg))
             p.Write()
         F.Close()
-
-        # Save logger #
-        #log_file = os.path.join(self.subdir,'log.out')
-        #self.logger.info(f'Saved log in {log_file}')
-        #self.logger.write(log_file)
-
+        self.report['outputs'][subdir] = os.path.getsize(hist_file)
+
+    @property
+    def total_events(self):
+        # Events processed by this task (only a part of N for a shard) #
+        if 'nshards' in self.params:
+            return shardLayout(int(self.params['N']),int(self.params['nshards']))[int(self.params['shard'])]['N']
+        return int(self.params['N'])
+
+    def timed_command(self,step,command,**kwargs):
+        # Run command and record its duration, exit code and progress in the report #
+        progress = CmsRunProgress(taskKey(self.params),step,self.total_events if step == 'cmsrun' else None)
+        start = time.time()
+        result = self.run_command(command,callback=progress,**kwargs)
+        self.report[f'{step}_time'] = time.time() - start
+        self.report[f'{step}_exit'] = result[0] if isinstance(result,tuple) else result
+        if step == 'cmsrun':
+            self.report.update(progress.summary())
+        progress.publish(phase='finished',exit=self.report[f'{step}_exit'])
+        return result
+
+    def readJobReport(self):
+        # Performance summary of the framework job report, if produced #
+        path = os.path.join(self.subdir,JOB_REPORT_FILE)
+        if not os.path.exists(path):
+            return
+        try:
+            metrics = parseJobReport(path)
+        except Exception as e:
+            self.logger.warning(f'Could not parse job report {path} : {e}')
+            return
+        self.report['job_report'] = metrics
+        if isinstance(metrics.get('TotalJobCPU'),float):
+            self.report['cpu_time'] = metrics['TotalJobCPU']
+        if isinstance(metrics.get('PeakValueRss'),float):
+            self.report['peak_rss'] = metrics['PeakValueRss']
+        self.logger.info(f'Job report : {self.report.get("events",0)} events at {self.report.get("event_rate") or 0.:.2f} events/s, peak RSS {self.report.get("peak_rss") or 0.:.0f} MB')
 
     @staticmethod
-    def format_command(cmd,wdir=None):
-        full_cmd = f"cd {CMSSW_DIR}"
-        if len(SETUP_CMSSW) > 0:
-            full_cmd += f" && {SETUP_CMSSW}"
-        if wdir is None:
-            wdir = os.getcwd()
-        full_cmd += f" && cd {wdir}"
-        if isinstance(cmd,str):
-            full_cmd += f" && {cmd}"
-        elif isinstance(cmd,list):
-            full_cmd += f" && {' '.join(cmd)}"
-        else:
-            return ValueError
-        return full_cmd
-
-    @staticmethod
-    def run_command(command,return_output=False,**kwargs):
+    def run_command(command,return_output=False,callback=None,**kwargs):
         process = subprocess.Popen(command,universal_newlines=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,**kwargs)
         # Poll process for new output until finished #
         output = []
@@ -192,6 +296,8 @@ class Task:
             nextline = nextline.strip()
             if len(nextline) == 0:
                 continue
+            if callback is not None:
+                callback(nextline)
             if return_output:
                 output.append(nextline)
         process.communicate()
@@ -202,12 +308,239 @@ class Task:
             return exitCode
 
 
+class PremixTask(Task):
+    """
+        Produces the premixed pileup library once per (N, pileup, HSfile, PUfile, replica)
+        -> the calibration tasks read the mixed events from it (premixfile argument) instead of running the mixing
+    """
+    def __init__(self,script,premixdir,params,worker=False,verbose=False,lean=False):
+        super().__init__(script,premixdir,params,worker,verbose,lean)
+
+    @property
+    def premix_params(self):
+        # Only the parameters changing the mixed events #
+        return {k:v for k,v in self.params.items() if k in DUMP_PARAMS+['replica','seed']}
+
+    def isDone(self):
+        return os.path.exists(os.path.join(self.subdir,PREMIX_FILE))
+
+    def run(self):
+        premix_file = os.path.join(self.subdir,PREMIX_FILE)
+        # Written in a temporary file so that a failed job is never reused #
+        tmp_file = premix_file.replace('.root','_tmp.root')
+        args = [f"{k}={v}" for k,v in self.premix_params.items()] + ['premix=1',f'premixfile={tmp_file}']
+        self.logger.info('Starting the premixed library production')
+        self.logger.info('Arguments : '+' '.join(args))
+        premix_cmd = ['cmsRun','-j',os.path.join(self.subdir,JOB_REPORT_FILE),self.script] + args
+        self.logger.debug(f'Command: {" ".join(premix_cmd)}')
+        rc,output = self.timed_command('cmsrun',premix_cmd,return_output=True,cwd=self.subdir,env=self.cmssw_env)
+        self.readJobReport()
+        self.logger.info(f'... exit code : {rc}')
+        if rc != 0:
+            msg = "Failed to produce the premixed library :\n"
+            for line in output:
+                msg += line + "\n"
+            raise RuntimeError(msg)
+        if not os.path.exists(tmp_file):
+            raise RuntimeError(f"Premixed library {tmp_file} not present")
+        os.replace(tmp_file,premix_file)
+        self.logger.info(f"Premixed library created as {premix_file}")
+
+        param_file = os.path.join(self.subdir,'params.json')
+        with open(param_file,'w') as handle:
+            json.dump(self.premix_params,handle,indent=4)
+        self.report['outputs'][self.subdir] = os.path.getsize(premix_file)
+
+
+class DumpTask(Task):
+    """
+        Produces the hit dump once per (N, pileup, HSfile, PUfile, replica) and emulates all the parameter points from it
+        -> cmsRun is skipped when the dump already exists
+    """
+    def __init__(self,script,dumpdir,subdirs,params,worker=False,verbose=False,lean=True):
+        self.subdirs = subdirs
+        self.points = [{k:str(v) for k,v in {**DEFAULT_PARAMS,**param}.items()} for param in params]
+        dump_params = dumpParams(params[0])
+        # Only one offset is needed to produce the dump, and the event content is never needed #
+        super().__init__(script,dumpdir,{**dump_params,'mode':'emulate','offset':0.},worker,verbose,lean=True)
+
+    def isDone(self):
+        return all(len(glob.glob(os.path.join(subdir,'BXHist*_harvested.root'))) > 0 for subdir in self.subdirs)
+
+    def run(self):
+        dump_file = os.path.join(self.subdir,HIT_DUMP_FILE)
+        if os.path.exists(dump_file):
+            self.logger.info(f'Reusing hit dump {dump_file}')
+        else:
+            self.produceDump(dump_file)
+        self.emulate(dump_file)
+
+    def produceDump(self,dump_file):
+        # Written in a temporary file so that a failed job is never reused #
+        tmp_file = dump_file.replace('.root','_tmp.root')
+        args = [f"{k}={v}" for k,v in self.params.items()] + ['dump=1',f'dumpfile={tmp_file}','lean=1']
+        self.logger.info('Starting the hit dump production')
+        self.logger.info('Arguments : '+' '.join(args))
+        dump_cmd = ['cmsRun','-j',os.path.join(self.subdir,JOB_REPORT_FILE),self.script] + args
+        self.logger.debug(f'Command: {" ".join(dump_cmd)}')
+        rc,output = self.timed_command('cmsrun',dump_cmd,return_output=True,cwd=self.subdir,env=self.cmssw_env)
+        self.readJobReport()
+        self.logger.info(f'... exit code : {rc}')
+        if rc != 0:
+            msg = "Failed to produce the hit dump :\n"
+            for line in output:
+                msg += line + "\n"
+            raise RuntimeError(msg)
+        if not os.path.exists(tmp_file):
+            raise RuntimeError(f"Hit dump {tmp_file} not present")
+
+        # The DQM output is not needed #
+        for dqm_file in glob.glob(os.path.join(self.subdir,'BXHist*_raw.root')) + glob.glob(os.path.join(self.subdir,DQM_SAVER_FILE)):
+            os.remove(dqm_file)
+        os.replace(tmp_file,dump_file)
+        self.logger.info(f"Hit dump created as {dump_file}")
+
+        param_file = os.path.join(self.subdir,'params.json')
+        with open(param_file,'w') as handle:
+            json.dump(self.params,handle,indent=4)
+
+    def emulate(self,dump_file):
+        from ..Emulator.emulator import HitEmulator, loadHits, writeHistograms, makeFileName
+
+        todo = [(subdir,point) for subdir,point in zip(self.subdirs,self.points)
+                if len(glob.glob(os.path.join(subdir,'BXHist*_harvested.root'))) == 0]
+        if len(todo) == 0:
+            self.logger.info('All points already emulated')
+            return
+        self.logger.info(f'Emulating {len(todo)} points from {dump_file}')
+        hits = loadHits(dump_file)
+        emulator = HitEmulator(seed=int(self.params['seed']),logger=self.logger)
+        results = emulator.emulate(hits,[point for _,point in todo])
+        for (subdir,point),hists in zip(todo,results):
+            if not os.path.exists(subdir):
+                os.makedirs(subdir)
+            hist_file = os.path.join(subdir,makeFileName(point))
+            writeHistograms(hist_file,hists)
+            self.logger.info(f'Emulated histograms saved in {hist_file}')
+            self.saveParameters(subdir,hist_file,{**point,'seed':self.params['seed']})
+
+
+class GroupTask(Task):
+    """
+        Runs several points differing only by analyzer parameters in a single cmsRun (one analyzer each)
+        -> the mixing is done once, the harvested file is then split in the results directory of each point
+    """
+    def __init__(self,script,groupdir,subdirs,params,worker=False,verbose=False,lean=False):
+        self.subdirs = subdirs
+        self.points = [{k:str(v) for k,v in {**DEFAULT_PARAMS,**param}.items()} for param in params]
+        group_params = {k:v for k,v in self.points[0].items() if k not in ANALYZER_PARAMS}
+        super().__init__(script,groupdir,group_params,worker,verbose,lean)
+
+    def isDone(self):
+        return all(len(glob.glob(os.path.join(subdir,'BXHist*_harvested.root'))) > 0 for subdir in self.subdirs)
+
+    def run(self):
+        points_file = os.path.join(self.subdir,'points.json')
+        with open(points_file,'w') as handle:
+            json.dump([{k:point[k] for k in ANALYZER_PARAMS} for point in self.points],handle,indent=4)
+        self.logger.info(f'Running {len(self.points)} analyzers in the same job')
+        group_file = self.produce([f'points={points_file}'])
+        self.split(group_file)
+        os.remove(group_file)
+        self.logger.info(f'Removed {group_file}')
+
+    def split(self,group_file):
+        self.logger.info('Starting splitting')
+        F_in = ROOT.TFile(group_file,'READ')
+        for i,(subdir,point) in enumerate(zip(self.subdirs,self.points)):
+            if not os.path.exists(subdir):
+                os.makedirs(subdir)
+            src = F_in.Get(f'DQMData/Run 1/Ph2TkBXHist_{i}')
+            if not src:
+                raise RuntimeError(f'Could not find folder of analyzer {i} in {group_file}')
+            hist_file = os.path.join(subdir,makeHistFileName(point))
+            F_out = ROOT.TFile(hist_file,'RECREATE')
+            self.copyDirectory(src,F_out.mkdir('DQMData').mkdir('Run 1').mkdir('Ph2TkBXHist'))
+            F_out.Close()
+            self.logger.info(f'... point {i} saved in {hist_file}')
+            self.saveParameters(subdir,hist_file,{**point,'seed':self.params['seed']})
+        F_in.Close()
+
+    @classmethod
+    def copyDirectory(cls,src,dst):
+        # Recursive copy of the content of a TDirectory #
+        for key in src.GetListOfKeys():
+            obj = key.ReadObj()
+            if obj.InheritsFrom('TDirectory'):
+                cls.copyDirectory(obj,dst.mkdir(key.GetName()))
+            else:
+                dst.cd()
+                obj.Write(key.GetName())
+
+
+class MergeTask(Task):
+    """
+        Merges the harvested histograms of the shards of a parameter point into a single file
+        -> the shard directories are removed once merged
+    """
+    def __init__(self,script,subdir,params,shardReports,worker=False,verbose=False,lean=False):
+        self.shardReports = shardReports
+        self.shardDirs = [report['subdir'] for report in shardReports]
+        super().__init__(script,subdir,params,worker,verbose,lean)
+
+    def run(self):
+        shard_files = []
+        for shardDir in self.shardDirs:
+            files = glob.glob(os.path.join(shardDir,'BXHist*_harvested.root'))
+            if len(files) != 1:
+                raise RuntimeError(f'Expected one harvested file in {shardDir}, found {len(files)}')
+            shard_files.append(files[0])
+        # All shards have the same file name, based on the total N #
+        hist_file = os.path.join(self.subdir,os.path.basename(shard_files[0]))
+        tmp_file = hist_file.replace('.root','_tmp.root')
+
+        self.logger.info(f'Merging {len(shard_files)} shards')
+        merger = ROOT.TFileMerger(False)
+        merger.OutputFile(tmp_file,'RECREATE')
+        for shard_file in shard_files:
+            merger.AddFile(shard_file)
+        # Only the histograms are merged, the parameters are saved below #
+        merger.AddObjectNames('DQMData')
+        if not merger.PartialMerge(ROOT.TFileMerger.kAll | ROOT.TFileMerger.kRegular | ROOT.TFileMerger.kOnlyListed):
+            raise RuntimeError(f'Failed to merge the shards into {tmp_file}')
+        os.replace(tmp_file,hist_file)
+        self.logger.info(f'Merged histograms saved as {hist_file}')
+
+        # The shard directories are removed below, only the events, inputs and seed of each shard are recorded #
+        layout = shardInputs(self.params,shardLayout(int(self.params['N']),len(self.shardDirs)))
+        for shard,shardReport in zip(layout,self.shardReports):
+            shard['seed'] = shardReport.get('seed')
+        # The histograms come from the seeds of the shards #
+        params = {k:v for k,v in self.params.items() if k != 'seed'}
+        self.saveParameters(self.subdir,hist_file,{**params,'shards':layout})
+
+        for shardDir in self.shardDirs:
+            shutil.rmtree(shardDir)
+        self.logger.info('Removed the shard directories')
+
+
+TASKS = {
+    'cmssw' : Task,
+    'dump'  : DumpTask,
+    'group' : GroupTask,
+}
+
 class Scan:
-    def __init__(self,script,output,logger,yaml_path=None):
+    def __init__(self,script,output,logger,yaml_path=None,task='cmssw',shard_size=None,premix=False):
         self.script = script
         self.output = output
         self.logger = logger
         self.yaml_path = yaml_path
+        self.task = task
+        self.shard_size = shard_size
+        self.shards = []
+        self.premix = premix
+        self.premixes = {}
         self.paramDict = self.getConfigContent()
         self.paramNames, self.paramValues = makeScan(self.paramDict)
         self.logger.info('Parameters for scan :')
@@ -239,41 +572,180 @@ class Scan:
         outputPaths = {'main': mainDir}
         outputPaths["infiles"] = os.path.join(mainDir, "infiles")
         outputPaths["results"] = os.path.join(mainDir, "results")
+        outputPaths["dumps"] = os.path.join(mainDir, "dumps")
+        outputPaths["groups"] = os.path.join(mainDir, "groups")
+        outputPaths["shards"] = os.path.join(mainDir, "shards")
+        outputPaths["premix"] = os.path.join(mainDir, "premix")
         for path in outputPaths.values():
             if not os.path.exists(path):
                 os.makedirs(path)
         return outputPaths
 
+    @functools.cached_property
+    def resultStore(self):
+        return ResultStore(self.outputPaths['results'],self.logger)
+
     def makeDaskArgs(self):
         # Make list of params dicts #
         fullParams = [{pN:pV for pN,pV in zip(self.paramNames,paramValues)} for paramValues in self.paramValues]
-        # check with what has been produced already #
-        subdirNums = []
-        for subdir in glob.glob(self.outputPaths['results']+'/*'):
-            # Check root file #
-            r_files = glob.glob(os.path.join(subdir,'*harvested*root'))
-            if len(r_files) == 0:
-                continue
-            # Check parameters #
-            p_file = os.path.join(subdir,'params.json')
-            if os.path.exists(p_file):
-                with open(p_file,'r') as handle:
-                    p_in_file = json.load(handle)
-                p_in_file = {k:v for k,v in p_in_file.items() if k in self.paramNames}
-                if p_in_file in fullParams:
-                    fullParams.remove(p_in_file)
-                    self.logger.debug(f'Found set of params already in {subdir}')
-                    subdirNums.append(os.path.basename(subdir))
-        self.logger.info(f'Submitting {len(fullParams)} tasks')
+        # Check with what has been produced already, through the result store index #
+        todo = []
+        for param in fullParams:
+            if self.resultStore.isDone(param):
+                self.logger.debug(f'Found set of params already in {self.resultStore.directory(param)}')
+            else:
+                todo.append(param)
+        self.logger.info(f'{len(fullParams)-len(todo)} points already produced, {len(todo)} to produce')
+        for param in todo:
+            self.resultStore.mark(param,'submitted')
+        self.resultStore.save()
+        if self.premix:
+            todo = [self.addPremix(param) for param in todo]
         # Make the args #
-        args = [[self.script]*len(fullParams),[None]*len(fullParams),[None]*len(fullParams)]
-        subdirNum = 0
-        for i,param in enumerate(fullParams):
-            while str(subdirNum) in subdirNums:
-                subdirNum += 1
-            subdirNums.append(str(subdirNum))
-            args[1][i] = os.path.join(self.outputPaths['results'],str(subdirNum))
-            args[2][i] = param
+        args = [[self.script]*len(todo),[self.resultStore.directory(param) for param in todo],todo]
+        if self.shard_size is not None:
+            args = self.makeShardedArgs(args[1],args[2])
+        if self.task == 'dump':
+            args = self.makeGroupedArgs(args[1],args[2],self.dumpKey,self.outputPaths['dumps'])
+        if self.task == 'group':
+            args = self.makeGroupedArgs(args[1],args[2],self.groupKey,self.outputPaths['groups'])
+        self.logger.info(f'Submitting {len(args[0])} tasks')
+        return args
+
+    def addPremix(self,param):
+        # One premixed library per set of parameters changing the simulated hits #
+        key = self.dumpKey(param)
+        premixDir = os.path.join(self.outputPaths['premix'],key)
+        if key not in self.premixes:
+            self.premixes[key] = (premixDir,dumpParams(param))
+        return {**param,'premixfile':os.path.join(premixDir,PREMIX_FILE)}
+
+    def makeShardedArgs(self,subdirs,params):
+        # Points with more than shard_size events are split in shards, run in parallel then merged #
+        args = [[],[],[]]
+        for subdir,param in zip(subdirs,params):
+            N = int(param.get('N',DEFAULT_PARAMS['N']))
+            nshards = math.ceil(N/self.shard_size)
+            if nshards <= 1:
+                args[0].append(self.script)
+                args[1].append(subdir)
+                args[2].append(param)
+                continue
+            mode = param.get('mode',DEFAULT_PARAMS['mode'])
+            offset = float(param.get('offset',DEFAULT_PARAMS['offset']))
+            if mode == 'emulate' and offset == -1.:
+                raise RuntimeError('Cannot shard points with a random emulation offset, all the shards must use the same one')
+            shardDirs = [os.path.join(self.outputPaths['shards'],os.path.basename(subdir),str(i)) for i in range(nshards)]
+            self.shards.append((subdir,param,shardDirs))
+        if len(self.shards) > 0:
+            self.logger.info(f'{len(self.shards)} points split in {sum(len(shard[2]) for shard in self.shards)} shards of at most {self.shard_size} events')
+        return args
+
+    @functools.cached_property
+    def ledger(self):
+        return Ledger(os.path.join(self.outputPaths['infiles'],LEDGER_FILE))
+
+    def submit(self,client,retries=0,**kwargs):
+        # Submit the tasks, with the merging of the shards depending on their completion #
+        # Works with the dask client and the PoolClient #
+        # Premixed libraries first, the tasks using them only start once they are produced #
+        premixFutures = {}
+        for key,(premixDir,premixParams) in self.premixes.items():
+            future = client.submit(runTask,PremixTask,self.script,premixDir,premixParams,retries=retries,**kwargs)
+            self.trackFuture(future,[premixParams],[premixDir],store=False,keys=[f'premix:{key}'])
+            premixFutures[os.path.join(premixDir,PREMIX_FILE)] = future
+        def requires(points):
+            return [premixFutures[path] for path in sorted({point['premixfile'] for point in points if 'premixfile' in point})]
+        futures = list(premixFutures.values())
+        # Points produced by each task (several for grouped tasks) #
+        points = self.args[3] if self.task in ['dump','group'] else [[param] for param in self.args[2]]
+        if len(self.args[0]) > 0 and len(premixFutures) == 0:
+            taskFutures = client.map(functools.partial(runTask,TASKS[self.task],**kwargs),*self.args,retries=retries)
+        else:
+            taskFutures = [client.submit(runTask,TASKS[self.task],*taskArgs,requires=requires(taskPoints),retries=retries,**kwargs)
+                           for *taskArgs,taskPoints in zip(*self.args,points)]
+        for future,taskPoints in zip(taskFutures,points):
+            self.trackFuture(future,taskPoints)
+        futures += taskFutures
+        for subdir,param,shardDirs in self.shards:
+            shardParams = [{**param,'shard':i,'nshards':len(shardDirs)} for i in range(len(shardDirs))]
+            shardFutures = [client.submit(runTask,Task,self.script,shardDir,shardParam,requires=requires([param]),retries=retries,**kwargs)
+                            for shardDir,shardParam in zip(shardDirs,shardParams)]
+            for future,shardParam,shardDir in zip(shardFutures,shardParams,shardDirs):
+                self.trackFuture(future,[shardParam],[shardDir],store=False)
+            mergeFuture = client.submit(runTask,MergeTask,self.script,subdir,param,shardFutures,retries=retries,**kwargs)
+            self.trackFuture(mergeFuture,[param])
+            futures += shardFutures + [mergeFuture]
+        return futures
+
+    def trackFuture(self,future,points,subdirs=None,store=True,keys=None):
+        # The index and ledger are only written by the client, when the tasks are over #
+        if subdirs is None:
+            subdirs = [self.resultStore.directory(point) for point in points]
+        if keys is None:
+            keys = [taskKey(point) for point in points]
+        for key,point,subdir in zip(keys,points,subdirs):
+            self.ledger.submit(key,paramHash(point),point,subdir)
+        def callback(future):
+            if future.cancelled():
+                report = {}
+                state = 'cancelled'
+                error = None
+            elif future.exception() is None:
+                report = future.result()
+                state = 'skipped' if report['skipped'] else 'done'
+                error = None
+            else:
+                exception = future.exception()
+                report = getattr(exception,'report',{})
+                state = 'failed'
+                error = repr(exception)
+            for key,subdir in zip(keys,subdirs):
+                self.ledger.finish(key,state,{**report,'output_size':report.get('outputs',{}).get(subdir)},error)
+            if store:
+                for point in points:
+                    self.resultStore.mark(point,'done' if state in ['done','skipped'] else 'failed')
+                with self.resultStore.lock:
+                    self.resultStore.save()
+        future.add_done_callback(callback)
+
+    @property
+    def nTasks(self):
+        return len(self.premixes) + len(self.args[0]) + sum([len(shardDirs)+1 for _,_,shardDirs in self.shards])
+
+    def memoryEstimate(self):
+        # Largest peak RSS seen in the ledger, with some margin #
+        peak_rss = self.ledger.maxPeakRss()
+        if peak_rss is None:
+            return DEFAULT_TASK_MEMORY
+        self.logger.info(f'Largest peak RSS of previous tasks : {peak_rss:.0f} MB')
+        return int(1.25 * peak_rss * 1024**2)
+
+    @staticmethod
+    def dumpKey(param):
+        key = {k:param.get(k,str(DEFAULT_PARAMS.get(k,''))) for k in DUMP_PARAMS}
+        # Replicas do not share their simulated hits (same key as before for the default replica) #
+        key.update({k:normalizeValue(v) for k,v in dumpParams(param).items() if k not in DUMP_PARAMS})
+        return hashlib.sha1(json.dumps(key,sort_keys=True).encode()).hexdigest()[:12]
+
+    @staticmethod
+    def groupKey(param):
+        key = {k:v for k,v in {**DEFAULT_PARAMS,**param}.items() if k not in ANALYZER_PARAMS}
+        return hashlib.sha1(json.dumps({k:str(v) for k,v in key.items()},sort_keys=True).encode()).hexdigest()[:12]
+
+    def makeGroupedArgs(self,subdirs,params,keyFunc,groupsDir):
+        # One task per group of points sharing the same key #
+        groups = {}
+        for subdir,param in zip(subdirs,params):
+            groupSubdirs,groupParams = groups.setdefault(keyFunc(param),([],[]))
+            groupSubdirs.append(subdir)
+            groupParams.append(param)
+        self.logger.info(f'{len(params)} points grouped in {len(groups)} tasks')
+        args = [[self.script]*len(groups),[],[],[]]
+        for key,(groupSubdirs,groupParams) in groups.items():
+            args[1].append(os.path.join(groupsDir,key))
+            args[2].append(groupSubdirs)
+            args[3].append(groupParams)
         return args
 
     def getParameters(self):
@@ -282,16 +754,28 @@ class Scan:
 
 def main():
     parser = argparse.ArgumentParser(description='Timing calibration setup')
-    parser.add_argument('--script',action='store',required=True,type=str,
-                        help='Name of the script in the CMSSW directory to run')
+    parser.add_argument('--script',action='store',required=False,type=str,default=None,
+                        help='Name of the script in the CMSSW directory to run (required unless --status)')
     parser.add_argument('-o','--output',action='store',required=True,type=str,default=None,
                         help='Name of subdir output directory (will be put in the `production` output directory)')
     parser.add_argument('--yaml',action='store',required=False,type=str,default=None,
                         help='Config to run several modes')
     parser.add_argument('--dask',action='store',required=False,type=str,default='local',
-                        help='Dask mode')
+                        help='Dask mode : local | slurm | htcondor | pool (process pool on the current node, without dask scheduler)')
+    parser.add_argument('--retries',action='store',required=False,type=int,default=0,
+                        help='Number of automatic resubmissions of failed tasks')
+    parser.add_argument('--task',action='store',required=False,type=str,default='cmssw',choices=list(TASKS.keys()),
+                        help='Task type : cmssw (full production for each point) | dump (reuse hit dump, produced once per N/pileup/HSfile/PUfile, and emulate the points) | group (one cmsRun with several analyzers for points sharing the same mixing)')
     parser.add_argument('--run',nargs='*',required=False,type=str,default=None,
                         help='Run parameters (with `=` between name of the arg and the value)')
+    parser.add_argument('--shard-size',action='store',required=False,type=int,default=None,
+                        help='Maximum number of events per job, points with larger N are split in shards run in parallel and merged (only with --task cmssw)')
+    parser.add_argument('--lean',action='store_true',default=False,
+                        help='Save the DQM histograms directly from the production job (no event content output, no harvesting job)')
+    parser.add_argument('--premix',action='store_true',default=False,
+                        help='Produce the mixed events once per (N, pileup, HSfile, PUfile) and reuse them for all the other parameters')
+    parser.add_argument('--status',action='store_true',default=False,
+                        help='Print the report of the scan from its ledger and exit')
     parser.add_argument('-v','--verbose',action='store_true',default=False,
                         help='Debug logger mode')
     parser.add_argument('--debug',action='store_true',default=False,
@@ -300,6 +784,31 @@ def main():
 
     # Logger #
     logger = Logger('BXRun','debug' if args.verbose else 'info','console')
+    # Status report #
+    if args.status:
+        outputDir = args.output if os.path.isabs(args.output) else os.path.join(OUTPUT_DIR,args.output)
+        ledger_path = os.path.join(outputDir,'infiles',LEDGER_FILE)
+        if not os.path.exists(ledger_path):
+            raise RuntimeError(f'No ledger found in {ledger_path}')
+        ledger = Ledger(ledger_path)
+        for line in ledger.summary():
+            logger.info(line)
+        ledger.close()
+        sys.exit(0)
+    if args.script is None:
+        raise RuntimeError('--script is required')
+    if args.shard_size is not None:
+        if args.task != 'cmssw':
+            raise RuntimeError('Sharding is only available with --task cmssw')
+        if args.run is not None:
+            raise RuntimeError('Sharding is only available in dask mode')
+        if args.shard_size <= 0:
+            raise RuntimeError('--shard-size must be positive')
+    if args.premix:
+        if args.task == 'dump':
+            raise RuntimeError('The premixed library cannot be used with --task dump, the hit dumps already skip the mixing')
+        if args.run is not None:
+            raise RuntimeError('The premixed library is only available in dask mode, use `premixfile=...` in --run')
     # Local mode #
     if args.run is not None:
         if args.yaml is not None:
@@ -308,37 +817,53 @@ def main():
         logger.info('Running in local mode with the following parameters :')
         for p_name,p_val in run_params.items():
             logger.info(f'... {p_name} = {p_val}')
-        task = Task(
-            script = args.script,
-            subdir = args.output,
-            params = run_params,
-            worker = True,
-            verbose = args.verbose,
-        )
+        # Same output directory for all the task types #
+        subdir = args.output if os.path.isabs(args.output) else os.path.join(OUTPUT_DIR,args.output)
+        if args.task == 'dump':
+            task = DumpTask(
+                script  = args.script,
+                dumpdir = os.path.join(subdir,'dump'),
+                subdirs = [subdir],
+                params  = [run_params],
+                worker  = True,
+                verbose = args.verbose,
+            )
+        else:
+            task = Task(
+                script = args.script,
+                subdir = subdir,
+                params = run_params,
+                worker = True,
+                verbose = args.verbose,
+                lean = args.lean,
+            )
     # Dask mode #
     else:
-        scan = Scan(args.script,args.output,logger,args.yaml)
+        scan = Scan(args.script,args.output,logger,args.yaml,args.task,args.shard_size,args.premix)
         if args.debug:
             logger.info('Entering debug mode, nothing will be submitted')
             embed()
             sys.exit(0)
+        # Process pool #
+        if args.dask == 'pool':
+            n_workers,cores,available = localWorkers(taskMemory(scan.memoryEstimate()),scan.nTasks)
+            logger.info(f'Process pool of {n_workers} workers ({cores} cores and {available/1024**3:.1f} GiB available)')
+            client = PoolClient(n_workers)
+            futures = scan.submit(client,retries=args.retries,lean=args.lean)
+            failed = client.wait(futures,logger,60)
+            client.close()
+            if len(failed) > 0:
+                logger.error(f'{len(failed)} tasks failed, see `BXRun -o {args.output} --status`')
+                sys.exit(1)
+            logger.info('All jobs finished successfully')
+            sys.exit(0)
         # Start cluster #
-        if args.dask == 'local':
-            from dask.distributed import LocalCluster
-            cluster = LocalCluster(n_workers=10,threads_per_worker=1,memory_limit='6GiB',scheduler_port=1234)
-        elif args.dask == 'slurm':
-            from dask_jobqueue import SLURMCluster
-            cluster = SLURMCluster()
-        elif args.dask == 'htcondor':
-            from dask_jobqueue import HTCondorCluster
-            cluster = HTCondorCluster()
-        else:
-            raise NotImplementedError(f'Dask mode {args.dask} not implemented')
+        cluster = makeCluster(args.dask,logger,scan.memoryEstimate(),scan.nTasks)
         # Start client #
         from dask.distributed import Client
         client = Client(cluster)
         # Submit and run loop #
-        futures = client.map(Task,*scan.args)
+        futures = scan.submit(client,retries=args.retries,lean=args.lean)
         loop = MonitoringLoop(futures,client,cluster,logger,60)
         loop.start(5)
 
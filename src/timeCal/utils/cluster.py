@@ -0,0 +1,123 @@
+import os
+import math
+import psutil
+
+from .environment import getEnv
+
+# Fraction of the available memory that can be given to the workers #
+MEMORY_FRACTION = 0.9
+CLUSTER_MODES = ['local','slurm','htcondor']
+# Defaults of the batch jobs, overridden by the timerc [dask] section #
+WORKERS_PER_JOB = 4
+MINIMUM_JOBS = 0
+MAXIMUM_JOBS = 100
+TARGET_DURATION = '1h'
+
+def parseValue(value):
+    # timerc values are strings #
+    if value.lower() in ['true','false']:
+        return value.lower() == 'true'
+    for cast in [int,float]:
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+def getDaskConfig():
+    # Overrides from the optional [dask] section of the timerc #
+    return {k:parseValue(v) for k,v in getEnv().get('dask',{}).items()}
+
+def availableCores():
+    if hasattr(os,'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+def taskMemory(memory_per_task):
+    # Memory of a single task in bytes, overridden by `memory_per_task` in timerc #
+    from dask.utils import parse_bytes
+    return parse_bytes(str(getDaskConfig().get('memory_per_task',memory_per_task)))
+
+def localWorkers(memory,n_tasks=None):
+    """
+        Number of single-threaded workers the node can hold
+        Input :
+            - memory [int] : memory estimate of a single task in bytes
+            - n_tasks [int] : number of tasks to run (None if unknown)
+        Return :
+            - [int] : number of workers
+            - [int] : number of available cores
+            - [int] : available memory in bytes
+    """
+    cores = availableCores()
+    available = psutil.virtual_memory().available
+    n_workers = max(1,min(cores,int(available*MEMORY_FRACTION // memory)))
+    if n_tasks is not None:
+        n_workers = max(1,min(n_workers,n_tasks))
+    return n_workers,cores,available
+
+def makeCluster(mode,logger,memory_per_task='2GiB',n_tasks=None):
+    """
+        Creates the dask cluster for the given mode
+        Input :
+            - mode [str] : local | slurm | htcondor
+            - logger [Logger] : logger
+            - memory_per_task [str/int] : memory estimate of a single task (overridden by `memory_per_task` in timerc)
+            - n_tasks [int] : number of tasks to run (None if unknown), bounds the number of workers
+        Return :
+            - [dask cluster]
+        Local workers are sized from the cores and available memory of the node
+        Batch jobs hold several single-core workers each, and are adaptively scaled between the minimum and maximum number of jobs
+        Any other entry of the [dask] section of the timerc is passed to the cluster class
+    """
+    import dask
+    from dask.utils import parse_bytes, format_bytes
+
+    config = getDaskConfig()
+    config.pop('memory_per_task',None)
+    memory = taskMemory(memory_per_task)
+
+    if mode == 'local':
+        from dask.distributed import LocalCluster
+        n_workers,cores,available = localWorkers(memory,n_tasks)
+        kwargs = {
+            'n_workers'          : n_workers,
+            'threads_per_worker' : 1,
+            'memory_limit'       : memory,
+            # Free ports, so that several clusters can run on the same node #
+            'scheduler_port'     : 0,
+            'dashboard_address'  : ':0',
+            **config,
+        }
+        logger.info(f'Local cluster : {kwargs["n_workers"]} workers of {format_bytes(parse_bytes(str(kwargs["memory_limit"])))} ({cores} cores and {format_bytes(available)} available)')
+        return LocalCluster(**kwargs)
+    elif mode in ['slurm','htcondor']:
+        if mode == 'slurm':
+            from dask_jobqueue import SLURMCluster as JobQueueCluster
+        else:
+            from dask_jobqueue import HTCondorCluster as JobQueueCluster
+        workers_per_job = config.pop('workers_per_job',WORKERS_PER_JOB)
+        minimum_jobs = config.pop('minimum_jobs',MINIMUM_JOBS)
+        maximum_jobs = config.pop('maximum_jobs',MAXIMUM_JOBS)
+        target_duration = config.pop('target_duration',TARGET_DURATION)
+        if n_tasks is not None:
+            # No need for more jobs than needed to run all the tasks at once #
+            maximum_jobs = max(minimum_jobs,min(maximum_jobs,math.ceil(n_tasks/workers_per_job)))
+        kwargs = {}
+        # Several single-core workers per job, values of the dask-jobqueue config are kept if present #
+        if dask.config.get(f'jobqueue.{mode}.cores',None) is None:
+            kwargs['cores'] = workers_per_job
+        if dask.config.get(f'jobqueue.{mode}.processes',None) is None:
+            kwargs['processes'] = workers_per_job
+        if dask.config.get(f'jobqueue.{mode}.memory',None) is None:
+            kwargs['memory'] = format_bytes(workers_per_job * memory)
+        kwargs['scheduler_options'] = {'dashboard_address':':0'}
+        kwargs.update(config)
+        logger.info(f'{mode} cluster : jobs with ' + ', '.join(f'{k} = {v}' for k,v in kwargs.items()))
+        cluster = JobQueueCluster(**kwargs)
+        # Scales up with the queue, and down to the minimum once the jobs run out of tasks #
+        logger.info(f'Adaptive scaling between {minimum_jobs} and {maximum_jobs} jobs (target duration {target_duration})')
+        cluster.adapt(minimum_jobs=minimum_jobs,maximum_jobs=maximum_jobs,target_duration=target_duration)
+        return cluster
+    else:
+        raise NotImplementedError(f'Dask mode {mode} not implemented')
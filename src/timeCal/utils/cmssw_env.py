@@ -0,0 +1,79 @@
+import os
+import json
+import hashlib
+import threading
+import subprocess
+
+# Environment captured once per process, for each (CMSSW directory, init command) #
+_CACHE = {}
+_LOCK = threading.Lock()
+
+MARKER = '__CMSSW_ENV__'
+# Variables specific to the capturing shell #
+SHELL_VARIABLES = ['PWD','OLDPWD','SHLVL','_']
+
+def cacheKey(cmssw_dir,init):
+    return hashlib.sha1(json.dumps([os.path.realpath(cmssw_dir),init]).encode()).hexdigest()[:16]
+
+def captureEnv(cmssw_dir,init,base_env):
+    """
+        Runs the init command once in a shell and returns the resulting environment
+        Input :
+            - cmssw_dir [str] : directory where the init command is run
+            - init [str] : command initializing the CMSSW environment (can be empty)
+            - base_env [dict] : environment the init command is run from
+        Return :
+            - [dict] : environment variables after the init command
+    """
+    # Marker to separate the output of the init command from the environment #
+    command = f"cd {cmssw_dir}"
+    if len(init) > 0:
+        command += f" && {init}"
+    command += f" && printf '\\0{MARKER}\\0' && env -0"
+    result = subprocess.run(['bash','-c',command],env=base_env,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f'Failed to initialize the CMSSW environment with `{init}` :\n{result.stderr.decode(errors="replace")}')
+    output = result.stdout.decode(errors='replace')
+    if f'\0{MARKER}\0' not in output:
+        raise RuntimeError(f'Could not find the environment in the output of `{init}`')
+    env = {}
+    for entry in output.split(f'\0{MARKER}\0')[-1].split('\0'):
+        if '=' in entry:
+            name,value = entry.split('=',1)
+            if name not in SHELL_VARIABLES:
+                env[name] = value
+    return env
+
+def getCMSSWEnv(cmssw_dir,init,base_env,cache_dir=None):
+    """
+        Returns the CMSSW environment, captured once per process and optionally cached on disk
+        Input :
+            - cmssw_dir [str] : directory where the init command is run
+            - init [str] : command initializing the CMSSW environment
+            - base_env [dict] : environment the init command is run from
+            - cache_dir [str] : directory of the disk cache (None for memory only)
+        Return :
+            - [dict] : copy of the environment
+    """
+    key = cacheKey(cmssw_dir,init)
+    with _LOCK:
+        if key not in _CACHE:
+            cache_file = None if cache_dir is None else os.path.join(cache_dir,f'cmssw_env_{key}.json')
+            env = None
+            if cache_file is not None and os.path.exists(cache_file):
+                with open(cache_file,'r') as handle:
+                    env = json.load(handle)
+                # Stale if the release has been moved or removed #
+                if 'CMSSW_BASE' in env and not os.path.isdir(env['CMSSW_BASE']):
+                    env = None
+            if env is None:
+                env = captureEnv(cmssw_dir,init,base_env)
+                if cache_file is not None:
+                    if not os.path.exists(cache_dir):
+                        os.makedirs(cache_dir)
+                    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+                    with open(tmp_file,'w') as handle:
+                        json.dump(env,handle)
+                    os.replace(tmp_file,cache_file)
+            _CACHE[key] = env
+        return dict(_CACHE[key])
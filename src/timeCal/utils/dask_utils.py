@@ -5,6 +5,10 @@ import dask.distributed
 from IPython import embed
 from collections import defaultdict
 import signal
+import datetime
+import threading
+
+from .telemetry import PROGRESS_TOPIC
 
 ORDER_STATUS = ['stored','pending','running','finished','cancelled','error','lost','cleaned']
 
@@ -16,6 +20,12 @@ class MonitoringLoop:
         self.logger = logger
         self.interval = interval
         self.statuses = defaultdict(lambda: 0)
+        # Last progress event of each running cmsRun, and number of events of the finished ones #
+        self.progress = {}
+        self.finishedEvents = []
+        self.progressLock = threading.Lock()
+        if hasattr(self.client,'subscribe_topic'):
+            self.client.subscribe_topic(PROGRESS_TOPIC,self.updateProgress)
 
     def close(self,exit=False):
         self.logger.info('Shutting down cluster and client')
@@ -58,6 +68,40 @@ class MonitoringLoop:
             if self.statuses[status] > 0:
                 self.logger.info(f'\t- {self.statuses[status]:5d} {status:15s} [{self.statuses[status]/len(self.futures)*100:6.2f}%]')
 
+    def updateProgress(self,event):
+        # Called by the client for each event sent by the workers #
+        _,message = event
+        if message['step'] != 'cmsrun':
+            return
+        with self.progressLock:
+            if message['phase'] == 'finished':
+                self.progress.pop(message['key'],None)
+                if message['exit'] == 0:
+                    self.finishedEvents.append(message['events'])
+            else:
+                self.progress[message['key']] = message
+
+    def printProgressInfo(self):
+        with self.progressLock:
+            running = list(self.progress.values())
+            finishedEvents = list(self.finishedEvents)
+        if len(running) == 0:
+            return
+        rate = sum([message['rate'] for message in running if message['rate'] is not None])
+        rss = sum([message['rss'] for message in running if message['rss'] is not None])
+        remaining = sum([max(message['total']-message['events'],0) for message in running if message['total'] is not None])
+        # Tasks not started yet are assumed to have the average size of the known ones #
+        known = finishedEvents + [message['total'] for message in running if message['total'] is not None]
+        notStarted = max(self.countRemaining() - len(running),0)
+        if len(known) > 0:
+            remaining += notStarted * sum(known) / len(known)
+        self.logger.info('Current throughput :')
+        self.logger.info(f'\t- {len(running):5d} cmsRun reporting ({len([m for m in running if m["phase"] == "init"])} initializing)')
+        self.logger.info(f'\t- {rate:8.2f} events/s')
+        self.logger.info(f'\t- {rss/1024:8.2f} GiB of RSS')
+        if rate > 0:
+            self.logger.info(f'\t- ETA {datetime.timedelta(seconds=int(remaining/rate))} for ~{int(remaining)} remaining events')
+
     def printClusterInfo(self):
         local = isinstance(self.cluster, dask.distributed.LocalCluster)
         self.logger.info(f'Cluster {self.cluster.status._value_} at {self.cluster.dashboard_link} : ')
@@ -133,6 +177,7 @@ class MonitoringLoop:
         if command == 'status':
             self.updateStatus()
             self.printStatusInfo()
+            self.printProgressInfo()
             self.printClusterInfo()
         if command == 'interval':
             self.logger.info(f'Current time interval is {self.interval}s')
@@ -206,6 +251,7 @@ class MonitoringLoop:
             # Printout #
             self.updateStatus()
             self.printStatusInfo()
+            self.printProgressInfo()
             self.printClusterInfo()
 
             # If nothing still running but not finished #
@@ -0,0 +1,146 @@
+import json
+import time
+import sqlite3
+import threading
+
+from .result_store import paramHash
+
+LEDGER_FILE = 'ledger.sqlite'
+
+# Per-task values reported by the workers (see Task.report) #
+REPORT_COLUMNS = {
+    'host'          : 'TEXT',
+    'start'         : 'REAL',
+    'end'           : 'REAL',
+    'cmsrun_time'   : 'REAL',
+    'cmsrun_exit'   : 'INTEGER',
+    'harvest_time'  : 'REAL',
+    'harvest_exit'  : 'INTEGER',
+    'output_size'   : 'INTEGER',
+    'events'        : 'INTEGER',
+    'event_rate'    : 'REAL',
+    'init_time'     : 'REAL',
+    'loop_time'     : 'REAL',
+    'cpu_time'      : 'REAL',
+    'peak_rss'      : 'REAL',
+    'seed'          : 'INTEGER',
+}
+
+def taskKey(params):
+    # Key of a task in the ledger and progress events, the shards of a point are different tasks #
+    key = paramHash(params)
+    if 'shard' in params:
+        key += f":shard{params['shard']}"
+    return key
+
+ORDER_STATES = ['submitted','done','skipped','failed','cancelled']
+
+
+class Ledger:
+    """
+        SQLite record of the tasks of a scan, kept in the `infiles` directory
+        -> `tasks` holds the last state of each task, `attempts` one row per finished attempt
+        -> only written by the client (the workers send their report back with the result)
+    """
+    def __init__(self,path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path,check_same_thread=False)
+        report_columns = ', '.join(f'{column} {sqltype}' for column,sqltype in REPORT_COLUMNS.items())
+        with self.lock, self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, hash TEXT, params TEXT, subdir TEXT, state TEXT, attempts INTEGER DEFAULT 0, submitted REAL, {report_columns}, error TEXT)'
+            )
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS attempts (key TEXT, attempt INTEGER, state TEXT, {report_columns}, error TEXT)'
+            )
+            # Ledgers created before new report columns were added #
+            for table in ['tasks','attempts']:
+                existing = [row[1] for row in self.connection.execute(f'PRAGMA table_info({table})').fetchall()]
+                for column,sqltype in REPORT_COLUMNS.items():
+                    if column not in existing:
+                        self.connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {sqltype}')
+
+    def close(self):
+        self.connection.close()
+
+    def submit(self,key,param_hash,params,subdir):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO tasks (key,hash,params,subdir,state,attempts,submitted) VALUES (?,?,?,?,?,1,?) '
+                'ON CONFLICT(key) DO UPDATE SET state=excluded.state, attempts=attempts+1, submitted=excluded.submitted, subdir=excluded.subdir',
+                (key,param_hash,json.dumps(params,sort_keys=True),subdir,'submitted',time.time()),
+            )
+
+    def finish(self,key,state,report,error=None):
+        values = {column:report.get(column) for column in REPORT_COLUMNS.keys()}
+        if values['end'] is None:
+            values['end'] = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                f'UPDATE tasks SET state=?, {", ".join(f"{column}=?" for column in values.keys())}, error=? WHERE key=?',
+                (state,*values.values(),error,key),
+            )
+            self.connection.execute(
+                f'INSERT INTO attempts (key,attempt,state,{",".join(values.keys())},error) '
+                f'SELECT key,attempts,?,{",".join("?"*len(values))},? FROM tasks WHERE key=?',
+                (state,*values.values(),error,key),
+            )
+
+    def states(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT state,COUNT(*) FROM tasks GROUP BY state').fetchall())
+
+    def failed(self):
+        with self.lock:
+            return self.connection.execute("SELECT key,subdir,attempts,host,error FROM tasks WHERE state='failed'").fetchall()
+
+    def maxPeakRss(self):
+        # Largest peak RSS [MB] of the finished tasks, None if unknown #
+        with self.lock:
+            peak_rss, = self.connection.execute("SELECT MAX(peak_rss) FROM attempts WHERE state='done'").fetchone()
+        return peak_rss
+
+    def summary(self):
+        # Lines of the `BXRun --status` report #
+        lines = []
+        states = self.states()
+        total = sum(states.values())
+        lines.append(f'{total} tasks in ledger {self.path}')
+        for state in ORDER_STATES + sorted(set(states.keys())-set(ORDER_STATES)):
+            if states.get(state,0) > 0:
+                lines.append(f'\t- {states[state]:5d} {state:15s} [{states[state]/total*100:6.2f}%]')
+        with self.lock:
+            attempts, = self.connection.execute('SELECT COUNT(*) FROM attempts').fetchone()
+            durations = self.connection.execute(
+                "SELECT AVG(end-start), MAX(end-start), AVG(cmsrun_time), AVG(harvest_time), SUM(output_size), AVG(event_rate), AVG(init_time), MAX(peak_rss) FROM attempts WHERE state='done'"
+            ).fetchone()
+            hosts = self.connection.execute(
+                "SELECT host,COUNT(*),SUM(end-start) FROM attempts WHERE host IS NOT NULL GROUP BY host ORDER BY COUNT(*) DESC"
+            ).fetchall()
+        lines.append(f'{attempts} finished attempts')
+        if durations[0] is not None:
+            lines.append(f'Task duration     : {durations[0]:8.1f}s average, {durations[1]:8.1f}s max')
+        if durations[2] is not None:
+            lines.append(f'cmsRun duration   : {durations[2]:8.1f}s average')
+        if durations[3] is not None:
+            lines.append(f'Harvest duration  : {durations[3]:8.1f}s average')
+        if durations[4] is not None:
+            lines.append(f'Output size       : {durations[4]/1024**3:8.3f} GiB')
+        if durations[5] is not None:
+            lines.append(f'Throughput        : {durations[5]:8.2f} events/s average per task')
+        if durations[6] is not None:
+            lines.append(f'cmsRun init       : {durations[6]:8.1f}s average')
+        if durations[7] is not None:
+            lines.append(f'Peak RSS          : {durations[7]:8.0f} MB')
+        if len(hosts) > 0:
+            lines.append('Hosts :')
+            for host,count,duration in hosts:
+                lines.append(f'\t- {host:30s} : {count:5d} attempts, {duration/3600:8.2f}h')
+        failed = self.failed()
+        if len(failed) > 0:
+            lines.append('Failed tasks :')
+            for key,subdir,attempts,host,error in failed:
+                error = '' if error is None else error.strip().split('\n')[0]
+                lines.append(f'\t- {key} ({attempts} attempts, last on {host}) in {subdir} : {error}')
+        return lines
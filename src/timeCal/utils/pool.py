@@ -0,0 +1,95 @@
+import time
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+
+
+class PoolClient:
+    """
+        Process pool with the subset of the dask client API used by the scans (submit/map with retries)
+        -> futures passed as arguments (or in lists, or as keyword arguments) are dependencies, resolved to their result before running
+        -> no scheduler nor open port, suited for single node runs and inside batch jobs
+    """
+    def __init__(self,max_workers):
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.running = set()
+
+    def close(self):
+        self.executor.shutdown(wait=True,cancel_futures=True)
+
+    def map(self,func,*iterables,retries=0):
+        return [self.submit(func,*args,retries=retries) for args in zip(*iterables)]
+
+    def submit(self,func,*args,retries=0,**kwargs):
+        future = Future()
+        values = list(args) + list(kwargs.values())
+        dependencies = [arg for arg in values if isinstance(arg,Future)] + \
+                       [f for arg in values if isinstance(arg,(list,tuple)) for f in arg if isinstance(f,Future)]
+        if len(dependencies) == 0:
+            self._run(future,func,args,kwargs,retries)
+            return future
+        # Submitted when all the dependencies are done #
+        remaining = [len(dependencies)]
+        def dependencyDone(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            failed = [f for f in dependencies if f.cancelled() or f.exception() is not None]
+            if len(failed) > 0:
+                future.set_exception(RuntimeError(f'{len(failed)} dependencies failed'))
+                return
+            resolved = [self._resolve(arg) for arg in args]
+            resolvedKwargs = {k:self._resolve(v) for k,v in kwargs.items()}
+            self._run(future,func,resolved,resolvedKwargs,retries)
+        for dependency in dependencies:
+            dependency.add_done_callback(dependencyDone)
+        return future
+
+    @staticmethod
+    def _resolve(arg):
+        if isinstance(arg,Future):
+            return arg.result()
+        if isinstance(arg,(list,tuple)):
+            return type(arg)(a.result() if isinstance(a,Future) else a for a in arg)
+        return arg
+
+    def _run(self,future,func,args,kwargs,retries):
+        # Inner attempts are resubmitted on failure, the outer future is only set at the end #
+        try:
+            attempt = self.executor.submit(func,*args,**kwargs)
+        except RuntimeError as e:
+            # Pool shut down #
+            future.set_exception(e)
+            return
+        with self.lock:
+            self.running.add(attempt)
+        def attemptDone(attempt):
+            with self.lock:
+                self.running.discard(attempt)
+            if attempt.cancelled():
+                future.cancel()
+            elif attempt.exception() is not None:
+                if retries > 0:
+                    self._run(future,func,args,kwargs,retries-1)
+                else:
+                    future.set_exception(attempt.exception())
+            else:
+                future.set_result(attempt.result())
+        attempt.add_done_callback(attemptDone)
+
+    def countRunning(self):
+        with self.lock:
+            return len([attempt for attempt in self.running if attempt.running()])
+
+    def wait(self,futures,logger,interval=60):
+        # Non-interactive progress printout until all futures are done #
+        start = time.time()
+        pending = set(futures)
+        while len(pending) > 0:
+            _,pending = wait(pending,timeout=interval)
+            failed = len([f for f in futures if f.done() and (f.cancelled() or f.exception() is not None)])
+            done = len([f for f in futures if f.done()]) - failed
+            logger.info(f'[{time.time()-start:8.0f}s] {done:5d} done, {failed:5d} failed, {self.countRunning():3d} running, {len(pending):5d} remaining (out of {len(futures)})')
+        return [f for f in futures if f.cancelled() or f.exception() is not None]
@@ -0,0 +1,132 @@
+import os
+import json
+import glob
+import hashlib
+import threading
+
+DEFAULT_PARAMS = {
+    'N'                  : 1,
+    'pileup'             : 200,
+    'pt'                 : 2.,
+    'threshold'          : 5800,
+    'thresholdsmearing'  : 0.,
+    'tofsmearing'        : 0.,
+    'mode'               : 'scan',
+    'subdet'             : 'ALL',
+    'offset'             : -1.,
+    'verbose'            : 0,
+}
+
+# Entries of params.json that do not change the result #
+IGNORED_PARAMS = ['verbose','shard','nshards','shards','premixfile','seed']
+# Parameters only present in some requests, left out of the hash at their default value #
+OPTIONAL_PARAMS = {
+    'replica' : 0,
+}
+# Seeds are passed as uint32 to the random generators #
+MAX_SEED = 2**31 - 1
+
+INDEX_FILE = 'index.json'
+HIST_PATTERN = 'BXHist*_harvested.root'
+
+def normalizeValue(value):
+    # Numbers compared by value (eg 200, '200' and '200.0'), anything else as string #
+    try:
+        return repr(float(value))
+    except (TypeError,ValueError):
+        return str(value)
+
+def normalizeParams(params):
+    return {k:normalizeValue(v) for k,v in {**DEFAULT_PARAMS,**params}.items()
+            if k not in IGNORED_PARAMS and not (k in OPTIONAL_PARAMS and normalizeValue(v) == normalizeValue(OPTIONAL_PARAMS[k]))}
+
+def paramHash(params):
+    return hashlib.sha1(json.dumps(normalizeParams(params),sort_keys=True).encode()).hexdigest()[:16]
+
+def paramSeed(params):
+    # Same parameters (and shard) always get the same seed, different replicas or shards get independent ones #
+    key = f"{paramHash(params)}:{params.get('shard',0)}"
+    return int(hashlib.sha1(key.encode()).hexdigest()[:8],16) % MAX_SEED + 1
+
+
+class ResultStore:
+    """
+        Results stored in <results>/<hash of the normalized parameters>
+        -> the index file maps each hash to its directory (relative to the results) and status
+        -> directories produced before the index existed are registered once from their params.json
+    """
+    def __init__(self,path,logger=None):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(self.path,INDEX_FILE)
+        if os.path.exists(self.index_path):
+            with open(self.index_path,'r') as handle:
+                self.index = json.load(handle)
+        else:
+            self.index = {}
+            self.migrate()
+
+    def migrate(self):
+        subdirs = [subdir for subdir in glob.glob(os.path.join(self.path,'*')) if os.path.isdir(subdir)]
+        if len(subdirs) == 0:
+            return
+        if self.logger is not None:
+            self.logger.info(f'Registering {len(subdirs)} existing result directories in {self.index_path}')
+        for subdir in subdirs:
+            json_path = os.path.join(subdir,'params.json')
+            if not os.path.exists(json_path):
+                continue
+            with open(json_path,'r') as handle:
+                params = json.load(handle)
+            status = 'done' if len(glob.glob(os.path.join(subdir,HIST_PATTERN))) > 0 else 'missing'
+            self.index[paramHash(params)] = {
+                'dir'    : os.path.basename(subdir),
+                'status' : status,
+                'params' : normalizeParams(params),
+            }
+        self.save()
+
+    def save(self):
+        # Written in a temporary file so that an interrupted write does not corrupt the index #
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path,'w') as handle:
+            json.dump(self.index,handle,indent=4)
+        os.replace(tmp_path,self.index_path)
+
+    def directory(self,params):
+        key = paramHash(params)
+        if key in self.index:
+            return os.path.join(self.path,self.index[key]['dir'])
+        return os.path.join(self.path,key)
+
+    def status(self,params):
+        entry = self.index.get(paramHash(params))
+        return None if entry is None else entry['status']
+
+    def isDone(self,params):
+        if self.status(params) == 'done':
+            return True
+        # Result produced without the index being updated (eg interrupted scan) #
+        if len(glob.glob(os.path.join(self.directory(params),HIST_PATTERN))) > 0:
+            self.mark(params,'done')
+            return True
+        return False
+
+    def mark(self,params,status):
+        with self.lock:
+            self.index[paramHash(params)] = {
+                'dir'    : os.path.basename(self.directory(params)),
+                'status' : status,
+                'params' : normalizeParams(params),
+            }
+
+    def find(self,paramNames):
+        # Directories of the done results, keyed by the normalized values of the requested parameters #
+        lookup = {}
+        for entry in self.index.values():
+            if entry['status'] != 'done':
+                continue
+            key = tuple(entry['params'].get(pName) for pName in paramNames)
+            lookup[key] = os.path.join(self.path,entry['dir'])
+        return lookup
@@ -0,0 +1,121 @@
+import re
+import time
+import socket
+import xml.etree.ElementTree as ET
+
+# Topic of the progress events sent to the scheduler by the workers #
+PROGRESS_TOPIC = 'cmsrun-progress'
+# Minimum time between two events sent by the same task [s] #
+PUBLISH_INTERVAL = 10.
+
+EVENT_REGEX = re.compile(r'Begin processing the (\d+)(?:st|nd|rd|th) record\.')
+MEMORY_REGEX = re.compile(r'VSIZE\s+([\d.]+)\s+[-\d.]+\s+RSS\s+([\d.]+)')
+
+def publish(message):
+    # Only possible from a dask worker, no-op otherwise (local mode, process pool) #
+    try:
+        from dask.distributed import get_worker
+        worker = get_worker()
+    except (ImportError,ValueError):
+        return
+    worker.log_event(PROGRESS_TOPIC,message)
+
+def parseJobReport(path):
+    """
+        Extracts the performance metrics of a framework job report (cmsRun -j)
+        Input :
+            - path [str] : path to the xml job report
+        Return :
+            - [dict] : metric name -> value (float if possible), for all the PerformanceSummary entries
+    """
+    metrics = {}
+    root = ET.parse(path).getroot()
+    for summary in root.iter('PerformanceSummary'):
+        for metric in summary.iter('Metric'):
+            name = metric.get('Name')
+            value = metric.get('Value')
+            try:
+                value = float(value)
+            except (TypeError,ValueError):
+                pass
+            metrics[name] = value
+    return metrics
+
+
+class CmsRunProgress:
+    """
+        Parses the cmsRun output lines (event records and SimpleMemoryCheck) of a task step
+        -> progress is sent to the scheduler at most every PUBLISH_INTERVAL seconds
+        -> the summary (events, throughput, peak RSS, phase timings) goes in the task report
+    """
+    def __init__(self,key,step,total_events,interval=PUBLISH_INTERVAL):
+        self.key = key
+        self.step = step
+        self.total_events = total_events
+        self.interval = interval
+        self.host = socket.gethostname()
+        self.start = time.time()
+        self.first_event = None
+        self.last_event = None
+        self.events = 0
+        self.rss = None
+        self.vsize = None
+        self.peak_rss = None
+        self.last_publish = 0.
+
+    def __call__(self,line):
+        match = EVENT_REGEX.search(line)
+        if match is not None:
+            self.events = int(match.group(1))
+            self.last_event = time.time()
+            if self.first_event is None:
+                self.first_event = self.last_event
+        else:
+            match = MEMORY_REGEX.search(line)
+            if match is None:
+                return
+            self.vsize = float(match.group(1))
+            self.rss = float(match.group(2))
+            self.peak_rss = self.rss if self.peak_rss is None else max(self.peak_rss,self.rss)
+        if time.time() - self.last_publish > self.interval:
+            self.publish()
+
+    @property
+    def rate(self):
+        # Events per second in the event loop #
+        if self.first_event is None or self.last_event == self.first_event:
+            return None
+        return (self.events-1) / (self.last_event-self.first_event)
+
+    @property
+    def phase(self):
+        return 'init' if self.first_event is None else 'events'
+
+    def snapshot(self):
+        return {
+            'key'     : self.key,
+            'step'    : self.step,
+            'host'    : self.host,
+            'phase'   : self.phase,
+            'events'  : self.events,
+            'total'   : self.total_events,
+            'rate'    : self.rate,
+            'rss'     : self.rss,
+            'vsize'   : self.vsize,
+            'elapsed' : time.time() - self.start,
+        }
+
+    def publish(self,**kwargs):
+        self.last_publish = time.time()
+        publish({**self.snapshot(),**kwargs})
+
+    def summary(self):
+        # Entries added to the task report #
+        end = time.time() if self.last_event is None else self.last_event
+        return {
+            'events'     : self.events,
+            'event_rate' : self.rate,
+            'peak_rss'   : self.peak_rss,
+            'init_time'  : None if self.first_event is None else self.first_event - self.start,
+            'loop_time'  : None if self.first_event is None else end - self.first_event,
+        }